@@ -1,3 +1,10 @@
+# Lazy imports are installed here, the earliest point shared by
+# the service (manage.py) and celery workers.
+from game_master.importing import install_lazy_imports, lazy_imports_enabled
+
+if lazy_imports_enabled():
+    install_lazy_imports()
+
 from anthill.framework.utils.version import get_version
 
 VERSION = (0, 0, 1, 'alpha', 1)
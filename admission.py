@@ -0,0 +1,155 @@
+# Admission control for bursty operations: room join, room spawn, party start.
+from anthill.framework.conf import settings
+from functools import wraps
+from collections import deque
+from typing import Dict, Hashable
+import asyncio
+import time
+
+ADMISSION_CONTROL = getattr(settings, 'ADMISSION_CONTROL', {})
+
+
+class AdmissionRejected(Exception):
+    """Operation is not admitted, client should retry after `retry_after` seconds."""
+
+    def __init__(self, retry_after: float, reason: str = None):
+        super().__init__(reason, retry_after)
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self) -> float:
+        """Seconds until a token is available, 0 if it is available now."""
+        self._refill(time.monotonic())
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else float('inf')
+
+    def consume(self) -> None:
+        self.tokens -= 1
+
+
+class AdmissionController:
+    """
+    Limits rate of an operation per region and per application version
+    with token buckets, and its concurrency with a bounded wait queue.
+    Waiters that are not admitted in `queue_timeout` seconds are rejected.
+    """
+
+    def __init__(self, name: str, rate: float = 100, burst: float = 200,
+                 max_concurrency: int = 64, max_queue: int = 256,
+                 queue_timeout: float = 2.0, max_buckets: int = 10000):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.max_buckets = max_buckets
+        self.in_flight = 0
+        self.buckets: Dict[Hashable, TokenBucket] = {}
+        self._waiters = deque()
+
+    @classmethod
+    def from_settings(cls, name: str) -> 'AdmissionController':
+        options = ADMISSION_CONTROL.get(name, {})
+        return cls(name, **{k.lower(): v for k, v in options.items()})
+
+    def _bucket(self, key: Hashable) -> TokenBucket:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.max_buckets:
+                self.buckets.clear()
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def _take_tokens(self, region_id, app_version_id) -> None:
+        buckets = [self._bucket(('region', region_id)),
+                   self._bucket(('app_version', app_version_id))]
+        wait = max(b.wait_time() for b in buckets)
+        if wait > 0:
+            raise AdmissionRejected(wait, '%s: rate limit exceeded' % self.name)
+        for b in buckets:
+            b.consume()
+
+    def _remove_waiter(self, waiter: asyncio.Future) -> None:
+        try:
+            self._waiters.remove(waiter)
+        except ValueError:  # already handed a slot by release()
+            pass
+
+    async def acquire(self, region_id=None, app_version_id=None) -> None:
+        queued = self.in_flight >= self.max_concurrency or bool(self._waiters)
+        if queued and len(self._waiters) >= self.max_queue:
+            raise AdmissionRejected(self.queue_timeout, '%s: queue is full' % self.name)
+        self._take_tokens(region_id, app_version_id)
+        if not queued:
+            self.in_flight += 1
+            return
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if waiter.done():  # admitted just in time
+                return
+            waiter.cancel()
+            self._remove_waiter(waiter)
+            raise AdmissionRejected(self.queue_timeout, '%s: queue timeout' % self.name)
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            else:
+                waiter.cancel()
+                self._remove_waiter(waiter)
+            raise
+
+    def release(self) -> None:
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                # Slot is handed over to the waiter, in_flight stays the same.
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+
+def admission_controlled(controller: AdmissionController, get_key=None):
+    """
+    Decorator for coroutine methods. `get_key` is a function receiving
+    decorated method arguments and returning (region_id, app_version_id)
+    tuple. It must not do any I/O, so that rejections stay cheap.
+    """
+    def decorator(f):
+        @wraps(f)
+        async def wrapper(*args, **kwargs):
+            key: tuple = (None, None)
+            if get_key is not None:
+                key = get_key(*args, **kwargs)
+            await controller.acquire(*key)
+            try:
+                return await f(*args, **kwargs)
+            finally:
+                controller.release()
+        return wrapper
+    return decorator
+
+
+_controllers: Dict[str, AdmissionController] = {}
+
+
+def get_controller(name: str) -> AdmissionController:
+    if name not in _controllers:
+        _controllers[name] = AdmissionController.from_settings(name)
+    return _controllers[name]
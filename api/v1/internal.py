@@ -11,3 +11,99 @@ Example:
         ...
 """
 from anthill.platform.api.internal import as_internal, InternalAPI
+from anthill.framework.utils.asynchronous import thread_pool_exec as future_exec
+from game_master.models import Room, Player, Party, PartySession
+from game_master.sharding import EntityNotFound
+from game_master.loadhistory import load_history
+from game_master.resume import party_events, session_resumer
+
+
+# Operations forwarded by the shard router to the owner of the entity.
+
+async def _get(model, kind, entity_id):
+    entity = await future_exec(model.query.get, entity_id)
+    if entity is None:
+        raise EntityNotFound(kind, entity_id)
+    return entity
+
+
+@as_internal()
+async def room_join(api: InternalAPI, room_id, user_id, ip_address=None, payload=None, **options):
+    room = await _get(Room, 'room', room_id)
+    player = Player(user_id=user_id, ip_address=ip_address, payload=payload or {})
+    await room.join_local(player)
+
+
+@as_internal()
+async def room_spawn(api: InternalAPI, room_id, **options):
+    room = await _get(Room, 'room', room_id)
+    return await room.spawn_local()
+
+
+@as_internal()
+async def party_start(api: InternalAPI, party_id, member_id, **options):
+    party = await _get(Party, 'party', party_id)
+    member = await _get(PartySession, 'party_session', member_id)
+    await party.start_local(member)
+
+
+
+# Party events and resume state, kept by the owner of the party.
+
+@as_internal()
+async def party_event_publish(api: InternalAPI, party_id, event, **options):
+    return party_events.publish_local(party_id, event)
+
+
+@as_internal()
+async def party_event_deliver(api: InternalAPI, party_id, seq, event, **options):
+    party_events.deliver(party_id, seq, event)
+
+
+@as_internal()
+async def party_events_last_seq(api: InternalAPI, party_id, **options):
+    return party_events.last_seq_local(party_id)
+
+
+@as_internal()
+async def party_events_since(api: InternalAPI, party_id, since, **options):
+    return party_events.since_local(party_id, since)
+
+
+@as_internal()
+async def party_events_drop(api: InternalAPI, party_id, **options):
+    party_events.drop_local(party_id)
+
+
+@as_internal()
+async def party_session_issue(api: InternalAPI, party_id, token, session_id, user_id, node, **options):
+    session_resumer.issue_local(party_id, token, session_id, user_id, node)
+
+
+@as_internal()
+async def party_session_suspend(api: InternalAPI, party_id, token, acked_seq, node, **options):
+    session_resumer.suspend_local(party_id, token, acked_seq, node)
+
+
+@as_internal()
+async def party_session_resume(api: InternalAPI, party_id, token, user_id, node, **options):
+    return session_resumer.resume_local(party_id, token, user_id, node)
+
+
+@as_internal()
+async def party_session_discard(api: InternalAPI, party_id, session_id=None, **options):
+    session_resumer.discard_local(party_id, session_id)
+
+
+@as_internal()
+async def party_session_take_over(api: InternalAPI, token, **options):
+    return await session_resumer.take_over_local(token)
+
+
+@as_internal()
+async def get_server_load_history(api: InternalAPI, server_id, metric='cpu_load',
+                                  resolution=None, since=None, **options):
+    history = load_history.get(server_id)
+    if history is None:
+        return None
+    return history.query(metric, resolution, since)
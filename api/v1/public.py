@@ -1,11 +1,22 @@
-import graphene
-from graphene_sqlalchemy import SQLAlchemyObjectType
-from game_master import models
+# Schema is built on first access of `schema` attribute (see GRAPHENE['SCHEMA']),
+# so that graphene is not executed at import time, e.g. with lazy imports.
+from functools import lru_cache
 
 
-class RootQuery(graphene.ObjectType):
-    pass
+@lru_cache(maxsize=None)
+def get_schema():
+    import graphene
+    from graphene_sqlalchemy import SQLAlchemyObjectType
+    from game_master import models
 
+    class RootQuery(graphene.ObjectType):
+        pass
 
-# noinspection PyTypeChecker
-schema = graphene.Schema(query=RootQuery)
+    # noinspection PyTypeChecker
+    return graphene.Schema(query=RootQuery)
+
+
+def __getattr__(name):
+    if name == 'schema':
+        return get_schema()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
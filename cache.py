@@ -1 +1,143 @@
 # Cache related code here, cache key methods for example.
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+# KEYS are pairs of (value key, version key). Sets value KEYS[2 * i - 1] to ARGV[2 * i]
+# and increments its version if the current version equals ARGV[2 * i - 1],
+# in one atomic step. Missing key has version 0. ARGV[#ARGV] is expiration
+# in seconds, 0 for none. Returns list of new versions, 0 for keys not updated.
+COMPARE_AND_SET_SCRIPT = """
+local ttl = tonumber(ARGV[#ARGV])
+local result = {}
+for i = 1, #KEYS / 2 do
+    local key, version_key = KEYS[2 * i - 1], KEYS[2 * i]
+    local expected = tonumber(ARGV[2 * i - 1])
+    local version = tonumber(redis.call('GET', version_key) or '0')
+    if version == 0 and redis.call('EXISTS', key) == 1 then
+        version = -1  -- written bypassing versions, never matches
+    end
+    if version == expected then
+        version = version + 1
+        if ttl > 0 then
+            redis.call('SET', key, ARGV[2 * i], 'EX', ttl)
+            redis.call('SET', version_key, version, 'EX', ttl)
+        else
+            redis.call('SET', key, ARGV[2 * i])
+            redis.call('SET', version_key, version)
+        end
+        result[i] = version
+    else
+        result[i] = 0
+    end
+end
+return result
+"""
+
+
+class ControllersStorage:
+    """
+    Bulk access to the controllers cache.
+    Every method costs one round trip to Redis, regardless of number of keys.
+
+    Every value has a version, incremented on each write, which is used
+    by compare and set. Values must be written through this class only,
+    so that versions are kept.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self._compare_and_set = None
+
+    def __getattr__(self, name):
+        return getattr(self.cache, name)
+
+    def _get_client(self):
+        return self.cache.client.get_client(write=True)
+
+    def _make_key(self, key) -> str:
+        return self.cache.make_key(key)
+
+    def _version_key(self, key) -> str:
+        return self.cache.make_key('%s:version' % key)
+
+    def _encode(self, value) -> bytes:
+        return self.cache.client.encode(value)
+
+    def _decode(self, value):
+        return self.cache.client.decode(value)
+
+    def _timeout(self, timeout) -> Optional[int]:
+        if timeout is None:
+            timeout = self.cache.default_timeout
+        return int(timeout) if timeout else None
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        keys = list(keys)
+        if not keys:
+            return {}
+        values = self._get_client().mget([self._make_key(k) for k in keys])
+        return {k: self._decode(v) for k, v in zip(keys, values) if v is not None}
+
+    def get_many_versioned(self, keys: Iterable[str]) -> Dict[str, Tuple[Any, int]]:
+        """Return {key: (value, version)} of existing keys."""
+        keys = list(keys)
+        if not keys:
+            return {}
+        result = self._get_client().mget(
+            [self._make_key(k) for k in keys] + [self._version_key(k) for k in keys])
+        values, versions = result[:len(keys)], result[len(keys):]
+        return {k: (self._decode(v), int(version or 0))
+                for k, v, version in zip(keys, values, versions) if v is not None}
+
+    def set_many(self, data: Dict[str, Any], timeout=None) -> None:
+        if not data:
+            return
+        timeout = self._timeout(timeout)
+        pipeline = self._get_client().pipeline(transaction=False)
+        for key, value in data.items():
+            version_key = self._version_key(key)
+            pipeline.set(self._make_key(key), self._encode(value), ex=timeout)
+            pipeline.incr(version_key)
+            if timeout is not None:
+                pipeline.expire(version_key, timeout)
+        pipeline.execute()
+
+    def set(self, key: str, value, timeout=None) -> None:
+        self.set_many({key: value}, timeout)
+
+    def delete_many(self, keys: Iterable[str]) -> int:
+        keys = list(keys)
+        if not keys:
+            return 0
+        client = self._get_client()
+        pipeline = client.pipeline(transaction=False)
+        pipeline.delete(*[self._make_key(k) for k in keys])
+        pipeline.delete(*[self._version_key(k) for k in keys])
+        return pipeline.execute()[0]
+
+    def delete(self, key: str) -> int:
+        return self.delete_many([key])
+
+    def compare_and_set_many(self, data: Dict[str, tuple], timeout=None) -> Dict[str, int]:
+        """
+        Atomically update keys given as {key: (expected version, new value)},
+        versions are returned by `get_many_versioned`.
+        Expected version `None` (or 0) means that the key must not exist.
+        Return {key: new version} of keys that were updated.
+        """
+        if not data:
+            return {}
+        client = self._get_client()
+        if self._compare_and_set is None:
+            self._compare_and_set = client.register_script(COMPARE_AND_SET_SCRIPT)
+        keys, redis_keys, args = list(data), [], []
+        for key in keys:
+            expected, value = data[key]
+            redis_keys += [self._make_key(key), self._version_key(key)]
+            args += [expected or 0, self._encode(value)]
+        args.append(self._timeout(timeout) or 0)
+        versions = self._compare_and_set(keys=redis_keys, args=args, client=client)
+        return {k: version for k, version in zip(keys, versions) if version}
+
+    def compare_and_set(self, key: str, expected, value, timeout=None) -> int:
+        """Return new version if the key was updated, 0 otherwise."""
+        return self.compare_and_set_many({key: (expected, value)}, timeout).get(key, 0)
@@ -0,0 +1,246 @@
+# Failure detection of controllers by heartbeat inter-arrival times.
+from anthill.framework.conf import settings
+from collections import deque
+from typing import Callable, Dict, List, Optional, Set
+import logging
+import math
+import threading
+import time
+
+logger = logging.getLogger('anthill.application')
+
+FAILURE_DETECTOR = getattr(settings, 'FAILURE_DETECTOR', {})
+
+TICK = FAILURE_DETECTOR.get('TICK', 0.1)  # seconds
+THRESHOLD = FAILURE_DETECTOR.get('THRESHOLD', 8.0)
+WINDOW = FAILURE_DETECTOR.get('WINDOW', 100)
+MIN_STD = FAILURE_DETECTOR.get('MIN_STD', 0.5)  # seconds
+ACCEPTABLE_PAUSE = FAILURE_DETECTOR.get('ACCEPTABLE_PAUSE', 0.0)  # seconds
+FIRST_HEARTBEAT_ESTIMATE = FAILURE_DETECTOR.get('FIRST_HEARTBEAT_ESTIMATE', 10.0)  # seconds
+
+
+class Timer:
+    __slots__ = ('expires', 'callback', 'cancelled')
+
+    def __init__(self, expires: int, callback: Callable[[], None]):
+        self.expires = expires
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+
+class TimerWheel:
+    """
+    Hierarchical timer wheel. Scheduling and cancelling are O(1),
+    each tick touches one slot, timers of upper levels are cascaded
+    down when the lower level wraps around.
+    """
+
+    LEVEL_BITS = (8, 6, 6, 6)
+
+    def __init__(self, tick: float = TICK, now: float = None):
+        self.tick = tick
+        self.shifts = []
+        shift = 0
+        for bits in self.LEVEL_BITS:
+            self.shifts.append(shift)
+            shift += bits
+        self.max_ticks = (1 << shift) - 1
+        self.levels: List[List[List[Timer]]] = [
+            [[] for _ in range(1 << bits)] for bits in self.LEVEL_BITS]
+        self.started_at = time.monotonic() if now is None else now
+        self.current = 0  # ticks processed
+        self.now = self.started_at  # time of the last advance
+
+    def _add(self, timer: Timer) -> None:
+        delta = timer.expires - self.current
+        if delta < 0:
+            timer.expires = self.current
+            delta = 0
+        for level, (bits, shift) in enumerate(zip(self.LEVEL_BITS, self.shifts)):
+            if delta < 1 << (shift + bits):
+                break
+        slots = self.levels[level]
+        slots[(timer.expires >> shift) & (len(slots) - 1)].append(timer)
+
+    def schedule(self, delay: float, callback: Callable[[], None], now: float = None) -> Timer:
+        now = time.monotonic() if now is None else now
+        ticks = int(math.ceil((now - self.started_at + delay) / self.tick))
+        timer = Timer(min(max(ticks, self.current + 1), self.current + self.max_ticks), callback)
+        self._add(timer)
+        return timer
+
+    def _cascade(self, level: int) -> bool:
+        """Move timers of the current slot of the level down. Return True if level wrapped."""
+        slots = self.levels[level]
+        index = (self.current >> self.shifts[level]) & (len(slots) - 1)
+        timers, slots[index] = slots[index], []
+        for timer in timers:
+            if not timer.cancelled:
+                self._add(timer)
+        return index == 0
+
+    def advance(self, now: float = None) -> None:
+        """Fire all timers expired by `now`."""
+        now = time.monotonic() if now is None else now
+        target = int((now - self.started_at) / self.tick)
+        self.now = now
+        level0 = self.levels[0]
+        while self.current < target:
+            self.current += 1
+            index = self.current & (len(level0) - 1)
+            if index == 0:
+                level = 1
+                while level < len(self.levels) and self._cascade(level):
+                    level += 1
+            timers, level0[index] = level0[index], []
+            for timer in timers:
+                if timer.cancelled:
+                    continue
+                try:
+                    timer.callback()
+                except Exception:
+                    logger.exception('Timer callback failed.')
+
+
+def _phi(y: float) -> float:
+    """-log10 of probability that heartbeat is still to come, logistic approximation of normal CDF."""
+    e = math.exp(-y * (1.5976 + 0.070566 * y * y))
+    if y > 0:
+        return -math.log10(e / (1.0 + e))
+    return -math.log10(1.0 - 1.0 / (1.0 + e))
+
+
+def _solve_phi(threshold: float) -> float:
+    low, high = -10.0, 40.0
+    for _ in range(60):
+        middle = (low + high) / 2
+        if _phi(middle) < threshold:
+            low = middle
+        else:
+            high = middle
+    return high
+
+
+class HeartbeatHistory:
+    def __init__(self, now: float):
+        self.intervals = deque(maxlen=WINDOW)
+        self.last = now
+
+    def add(self, now: float) -> None:
+        self.intervals.append(now - self.last)
+        self.last = now
+
+    def stats(self):
+        if not self.intervals:
+            mean, std = FIRST_HEARTBEAT_ESTIMATE, FIRST_HEARTBEAT_ESTIMATE / 4
+        else:
+            n = len(self.intervals)
+            mean = sum(self.intervals) / n
+            std = math.sqrt(sum((i - mean) ** 2 for i in self.intervals) / n)
+        return mean + ACCEPTABLE_PAUSE, max(std, MIN_STD)
+
+    def phi(self, now: float) -> float:
+        mean, std = self.stats()
+        return _phi((now - self.last - mean) / std)
+
+
+class FailureDetector:
+    """
+    Phi accrual failure detector for servers.
+
+    Suspicion level is derived from the distribution of recent heartbeat
+    inter-arrival times of each server. Instead of checking every server
+    periodically, each heartbeat (re)schedules one timer in a timer wheel
+    at the moment suspicion would reach `THRESHOLD`.
+    """
+
+    def __init__(self, threshold: float = THRESHOLD, tick: float = TICK, now: float = None):
+        self.threshold = threshold
+        # Phi depends only on normalized distance from the mean inter-arrival
+        # time, so the distance at which it reaches the threshold is constant.
+        self.y_threshold = _solve_phi(threshold)
+        self.wheel = TimerWheel(tick, now)
+        self.histories: Dict[int, HeartbeatHistory] = {}
+        self.timers: Dict[int, Timer] = {}
+        self.suspected: Set[int] = set()
+        self.on_suspect: Optional[Callable[[int], None]] = None
+        self.lock = threading.RLock()
+
+    def _schedule(self, server_id: int, now: float) -> None:
+        history = self.histories[server_id]
+        mean, std = history.stats()
+        deadline = history.last + mean + self.y_threshold * std
+        timer = self.timers.pop(server_id, None)
+        if timer is not None:
+            timer.cancel()
+        self.timers[server_id] = self.wheel.schedule(
+            deadline - now, lambda: self._expire(server_id), now)
+
+    def watch(self, server_id: int, now: float = None) -> None:
+        """Start tracking the server as if it has just sent a heartbeat."""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            if server_id not in self.histories:
+                self.histories[server_id] = HeartbeatHistory(now)
+                self._schedule(server_id, now)
+
+    def heartbeat(self, server_id: int, now: float = None) -> None:
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            history = self.histories.get(server_id)
+            if history is None:
+                history = self.histories[server_id] = HeartbeatHistory(now)
+            else:
+                history.add(now)
+            self.suspected.discard(server_id)
+            self._schedule(server_id, now)
+
+    def suspect(self, server_id: int) -> None:
+        with self.lock:
+            if server_id in self.suspected:
+                return
+            self.suspected.add(server_id)
+            timer = self.timers.pop(server_id, None)
+            if timer is not None:
+                timer.cancel()
+        if self.on_suspect is not None:
+            self.on_suspect(server_id)
+
+    def _expire(self, server_id: int) -> None:
+        with self.lock:
+            self.timers.pop(server_id, None)
+            history = self.histories.get(server_id)
+            if history is None or server_id in self.suspected:
+                return
+            now = self.wheel.now
+            if self.phi(server_id, now) < self.threshold:  # e.g. window statistics changed
+                self._schedule(server_id, now)
+                return
+        self.suspect(server_id)
+
+    def phi(self, server_id: int, now: float = None) -> float:
+        history = self.histories.get(server_id)
+        if history is None:
+            return 0.0
+        return history.phi(time.monotonic() if now is None else now)
+
+    def is_suspected(self, server_id: int) -> bool:
+        return server_id in self.suspected
+
+    def remove(self, server_id: int) -> None:
+        with self.lock:
+            self.histories.pop(server_id, None)
+            self.suspected.discard(server_id)
+            timer = self.timers.pop(server_id, None)
+            if timer is not None:
+                timer.cancel()
+
+    def tick(self, now: float = None) -> None:
+        with self.lock:
+            self.wheel.advance(now)
+
+
+failure_detector = FailureDetector()
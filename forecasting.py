@@ -0,0 +1,262 @@
+# Room demand forecasting and pre-warming of room capacity per region.
+from anthill.framework.conf import settings
+from array import array
+from collections import defaultdict, deque
+from typing import Dict, Iterable, List, Optional, Tuple
+import datetime
+import logging
+import math
+
+logger = logging.getLogger('anthill.application')
+
+PREWARM = getattr(settings, 'PREWARM', {})
+
+SLOT = PREWARM.get('SLOT', 15 * 60)  # seconds
+WEEK = 7 * 24 * 3600
+SLOTS = WEEK // SLOT
+SMOOTHING = PREWARM.get('SMOOTHING', 0.3)  # weight of the most recent week
+HISTORY_WEEKS = PREWARM.get('HISTORY_WEEKS', 4)
+LEAD_TIME = PREWARM.get('LEAD_TIME', 60)  # seconds, expected room startup time
+INTERVAL = PREWARM.get('INTERVAL', 60)  # seconds
+SAFETY_FACTOR = PREWARM.get('SAFETY_FACTOR', 1.2)
+MAX_WARM_ROOMS = PREWARM.get('MAX_WARM_ROOMS', 20)  # per region and app version
+MAX_PLAYERS_COUNT = PREWARM.get('MAX_PLAYERS_COUNT', 10)
+
+Key = Tuple[Optional[int], Optional[int]]  # (region_id, app_version_id)
+
+
+class SeasonalRateModel:
+    """Weekly profile of event rate, one exponentially smoothed value per slot."""
+
+    def __init__(self):
+        self.rates = array('d', bytes(8 * SLOTS))  # events per second
+        self.weeks = 0
+
+    def fit_week(self, counts: Dict[int, int]) -> None:
+        alpha = 1.0 if not self.weeks else SMOOTHING
+        for slot in range(SLOTS):
+            rate = counts.get(slot, 0) / SLOT
+            self.rates[slot] += alpha * (rate - self.rates[slot])
+        self.weeks += 1
+
+    def expected(self, start: float, end: float) -> float:
+        """Expected number of events in [start, end) interval."""
+        total = 0.0
+        t = start
+        while t < end:
+            slot_end = (t // SLOT + 1) * SLOT
+            step = min(slot_end, end) - t
+            total += self.rates[int(t % WEEK // SLOT)] * step
+            t += step
+        return total
+
+
+class DemandForecaster:
+    """Forecasts room creation per region and application version."""
+
+    def __init__(self):
+        self.models: Dict[Key, SeasonalRateModel] = {}
+
+    def fit(self, events: Iterable[Tuple[float, Optional[int], Optional[int]]]) -> None:
+        """Learn from (timestamp, region_id, app_version_id) of created rooms."""
+        counts = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
+        first_week = last_week = None
+        for ts, region_id, app_version_id in events:
+            week = int(ts // WEEK)
+            counts[(region_id, app_version_id)][week][int(ts % WEEK // SLOT)] += 1
+            first_week = week if first_week is None else min(first_week, week)
+            last_week = week if last_week is None else max(last_week, week)
+        models = {}
+        for key, weeks in counts.items():
+            model = models[key] = SeasonalRateModel()
+            for week in range(first_week, last_week + 1):
+                model.fit_week(weeks.get(week, {}))
+        self.models = models
+
+    def fit_from_db(self, now: float) -> None:
+        from game_master.models import Room, Server, GeoLocation
+        # Learn from whole weeks only, the current one is incomplete.
+        until = now // WEEK * WEEK
+        since = until - HISTORY_WEEKS * WEEK
+        # Pre-warmed rooms count when claimed, unclaimed ones are not demand.
+        query = Room.query \
+            .outerjoin(Server).outerjoin(GeoLocation) \
+            .with_entities(Room.demanded_at, GeoLocation.region_id, Room.app_version_id) \
+            .filter(Room.demanded_at >= _to_datetime(since), Room.demanded_at < _to_datetime(until))
+        self.fit((demanded_at.timestamp(), region_id, app_version_id)
+                 for demanded_at, region_id, app_version_id in query.yield_per(1000))
+
+    def expected(self, key: Key, start: float, end: float) -> float:
+        model = self.models.get(key)
+        return model.expected(start, end) if model else 0.0
+
+    def targets(self, now: float, horizon: float = LEAD_TIME + INTERVAL) -> Dict[Key, int]:
+        """Number of warm rooms required per key to serve predicted demand."""
+        return {
+            key: min(int(math.ceil(model.expected(now, now + horizon) * SAFETY_FACTOR)), MAX_WARM_ROOMS)
+            for key, model in self.models.items()
+        }
+
+
+def _to_datetime(ts: float) -> datetime.datetime:
+    return datetime.datetime.fromtimestamp(ts, tz=datetime.timezone.utc)
+
+
+class Prewarmer:
+    """
+    Keeps pools of spawned, empty rooms per region and application version,
+    sized by demand forecast for the next `LEAD_TIME + INTERVAL` seconds.
+    """
+
+    def __init__(self, forecaster: DemandForecaster = None):
+        self.forecaster = forecaster or DemandForecaster()
+        self.pools: Dict[Key, deque] = defaultdict(deque)  # key -> room ids
+        self.servers: Dict[int, int] = {}  # room id -> server id
+
+    def claim(self, region_id, app_version_id) -> Optional[int]:
+        """Take a warm room id from the pool, skipping rooms on suspected servers."""
+        from game_master.failure_detector import failure_detector
+        pool = self.pools.get((region_id, app_version_id))
+        while pool:
+            room_id = pool.popleft()
+            server_id = self.servers.pop(room_id, None)
+            if server_id is None or not failure_detector.is_suspected(server_id):
+                return room_id
+
+    async def spawn_room(self, region_id, app_version_id) -> Optional[int]:
+        from game_master.models import Room, Server
+        server = await Server.get_optimal(region_id)
+        if server is None:
+            return None
+        # Not demanded yet, so that the forecast doesn't learn from its own output.
+        room = await Room.create_room(
+            server_id=server.id, app_version_id=app_version_id,
+            max_players_count=MAX_PLAYERS_COUNT, demanded_at=None)
+        await room.spawn()
+        self.servers[room.id] = server.id
+        return room.id
+
+    def dump(self, writer) -> None:
+        models = list(self.forecaster.models.items())
+        writer.write_int(len(models))
+        for (region_id, app_version_id), model in models:
+            writer.write_optional_int(region_id)
+            writer.write_optional_int(app_version_id)
+            writer.write_int(model.weeks)
+            writer.write_array(model.rates)
+        pools = [(key, pool) for key, pool in self.pools.items() if pool]
+        writer.write_int(len(pools))
+        for (region_id, app_version_id), pool in pools:
+            writer.write_optional_int(region_id)
+            writer.write_optional_int(app_version_id)
+            writer.write_array(array('q', pool))
+
+    def restore(self, reader, created_at: float) -> None:
+        models = {}
+        for _ in range(reader.read_int()):
+            key = reader.read_optional_int(), reader.read_optional_int()
+            model = SeasonalRateModel()
+            model.weeks = reader.read_int()
+            rates = reader.read_array()
+            if len(rates) == SLOTS:  # otherwise slot size was changed
+                model.rates = rates
+                models[key] = model
+        self.forecaster.models = models
+        for _ in range(reader.read_int()):
+            key = reader.read_optional_int(), reader.read_optional_int()
+            self.pools[key].extend(reader.read_array())
+
+    @staticmethod
+    def _available_rooms(room_ids: List[int]) -> Dict[int, int]:
+        """Return server ids of the rooms that still exist, are empty and on active servers."""
+        from game_master.models import Room, Server
+        return dict(Room.query
+                    .join(Server)
+                    .filter(Room.id.in_(room_ids), ~Room.players.any(),
+                            Server.enabled.is_(True), Server.status == 'active')
+                    .with_entities(Room.id, Room.server_id))
+
+    async def prune(self) -> None:
+        """Drop pooled rooms that are removed, already taken or on failed servers."""
+        from anthill.framework.utils.asynchronous import thread_pool_exec as future_exec
+        from game_master.failure_detector import failure_detector
+        room_ids = [room_id for pool in self.pools.values() for room_id in pool]
+        if not room_ids:
+            return
+        available = await future_exec(self._available_rooms, room_ids)
+        checked = set(room_ids)
+
+        def keep(room_id):
+            if room_id not in checked:  # pooled while querying
+                return True
+            server_id = available.get(room_id)
+            return server_id is not None and not failure_detector.is_suspected(server_id)
+
+        for key, pool in self.pools.items():
+            self.pools[key] = deque(filter(keep, pool))
+        self.servers.update(available)
+        pooled = {room_id for pool in self.pools.values() for room_id in pool}
+        for room_id in set(self.servers) - pooled:
+            del self.servers[room_id]
+
+    async def refit(self, now: float) -> None:
+        from anthill.framework.utils.asynchronous import thread_pool_exec as future_exec
+        await future_exec(self.forecaster.fit_from_db, now)
+
+    async def run(self, now: float) -> None:
+        await self.prune()
+        for (region_id, app_version_id), target in self.forecaster.targets(now).items():
+            pool = self.pools[(region_id, app_version_id)]
+            for _ in range(target - len(pool)):
+                try:
+                    room_id = await self.spawn_room(region_id, app_version_id)
+                except Exception:
+                    logger.exception('Cannot pre-warm room.')
+                    break
+                if room_id is None:
+                    break
+                pool.append(room_id)
+
+
+prewarmer = Prewarmer()
+
+
+def replay(trace: List[Tuple[float, Optional[int], Optional[int]]],
+           forecaster: Optional[DemandForecaster], cold_start: float = LEAD_TIME,
+           interval: float = INTERVAL, claim_time: float = 0.0) -> List[float]:
+    """
+    Replay recorded room requests (timestamp, region_id, app_version_id)
+    and return time-to-room of each of them. Without forecaster every
+    request waits for a cold start. With it, warm rooms are spawned every
+    `interval` seconds up to forecast targets and become ready after
+    `cold_start` seconds.
+    """
+    trace = sorted(trace, key=lambda e: e[0])
+    if not trace:
+        return []
+    pending: Dict[Key, List[float]] = defaultdict(list)  # ready times of warm rooms
+    waits = []
+    next_tick = trace[0][0]
+    for ts, region_id, app_version_id in trace:
+        key = (region_id, app_version_id)
+        while forecaster is not None and next_tick <= ts:
+            for k, target in forecaster.targets(next_tick, cold_start + interval).items():
+                pool = pending[k]
+                pool.extend([next_tick + cold_start] * (target - len(pool)))
+            next_tick += interval
+        pool = pending.get(key)
+        if pool:
+            ready_at = min(pool)
+            pool.remove(ready_at)
+            # A room that gets ready later than a cold started one is not waited for.
+            waits.append(min(max(ready_at - ts, 0.0) + claim_time, cold_start))
+        else:
+            waits.append(cold_start)
+    return waits
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(q / 100 * len(values)), len(values) - 1)]
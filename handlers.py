@@ -1,13 +1,19 @@
 from anthill.framework.utils.asynchronous import as_future, thread_pool_exec as future_exec
 from anthill.platform.handlers.jsonrpc import JsonRPCSessionHandler, jsonrpc_method
 from anthill.platform.handlers import UserHandlerMixin
-from game_master.models import Party
+from game_master.models import Party, PartySession, PartySessionPermissionError
+from game_master.resume import party_events, session_resumer
+import json
 
 
 class BasePartySessionHandler(JsonRPCSessionHandler, UserHandlerMixin):
     def __init__(self, application, request, **kwargs):
         super().__init__(self, application, request, **kwargs)
         self.session = None
+        self.resume_token = None
+        self.acked_seq = 0
+        self.delivered_seq = 0
+        self.pending_events = None
 
     def check_origin(self, origin):
         return True
@@ -15,18 +21,79 @@ class BasePartySessionHandler(JsonRPCSessionHandler, UserHandlerMixin):
     async def prepare(self):
         await super().prepare()
 
+    def notify(self, method, params):
+        self.write_message(json.dumps({'jsonrpc': '2.0', 'method': method, 'params': params}))
+
+    def on_party_event(self, seq, event):
+        if self.pending_events is not None:  # missed events are not replayed yet
+            self.pending_events.append((seq, event))
+            return
+        if seq <= self.delivered_seq:
+            return
+        self.delivered_seq = seq
+        self.notify('party_event', {'seq': seq, 'event': event})
+
     async def open(self, *args, **kwargs):
         await super().open(*args, **kwargs)
-        party = await Party.create_party()  # TODO:
-        self.session = await party.create_session()  # TODO:
+        token = self.get_argument('resume_token', None)
+        resumed = None
+        if token:
+            resumed = await session_resumer.resume(
+                token, getattr(self.current_user, 'id', None), self)
+        if resumed:
+            session_id, acked_seq = resumed
+            self.session = await future_exec(PartySession.query.get, session_id)
+        if self.session is not None:
+            self.resume_token = token
+            self.acked_seq = int(self.get_argument('last_seq', acked_seq))
+        else:
+            resumed = None
+            party = await Party.create_party()  # TODO:
+            self.session = await party.create_session()  # TODO:
+            self.resume_token = await session_resumer.issue(self.session, self)
+            self.acked_seq = await party_events.last_seq(self.session.party_id)
+
+        self.delivered_seq = self.acked_seq
+        self.pending_events = []
+        missed = await party_events.subscribe(self.session.party_id, self.on_party_event, self.acked_seq)
+        pending, self.pending_events = self.pending_events, None
+        self.notify('session', {
+            'resume_token': self.resume_token,
+            'seq': self.acked_seq,
+            'resumed': bool(resumed),
+            # Too many events were missed, client has to fetch party state again.
+            'resync': missed is None,
+        })
+        for seq, event in sorted(list(missed or ()) + pending, key=lambda e: e[0]):
+            self.on_party_event(seq, event)
+
+    async def detach(self, reason=None) -> int:
+        """Close the connection leaving the session to another one, return acknowledged seq."""
+        if self.session is not None:
+            party_events.unsubscribe(self.session.party_id, self.on_party_event)
+            self.session = None
+        await self.close(4000, reason)
+        return self.acked_seq
 
     async def close(self, code=None, reason=None):
-        await self.session.close(code, reason)
+        if self.session is not None:
+            party_events.unsubscribe(self.session.party_id, self.on_party_event)
+            await session_resumer.suspend(self.resume_token, self.acked_seq, self)
         await super().close(code, reason)
 
     @jsonrpc_method()
-    async def update_party(self):
-        pass
+    async def ack(self, seq):
+        """Acknowledge party events up to `seq`."""
+        self.acked_seq = max(self.acked_seq, int(seq))
+
+    @jsonrpc_method()
+    async def update_party(self, patch):
+        """Update party settings with JSON patch operations."""
+        if not self.session.has_permission(PartySession.Permissions.ADMIN):
+            raise PartySessionPermissionError
+        party = await future_exec(getattr, self.session, 'party')
+        await party.patch_json('settings', patch)
+        await party_events.publish(party.id, {'type': 'settings_updated', 'patch': patch})
 
     @jsonrpc_method()
     async def close_party(self):
@@ -0,0 +1,96 @@
+# Import time helpers: lazy loading of heavy dependencies and import profiling.
+# This module must not import anything from anthill, it is used before setup.
+from importlib.util import LazyLoader
+from typing import Iterable, List, Tuple
+import importlib
+import os
+import subprocess
+import sys
+
+LAZY_IMPORTS_ENV = 'GAME_MASTER_LAZY_IMPORTS'
+
+# Top level packages whose execution is deferred until the first attribute access.
+DEFAULT_LAZY_MODULES = (
+    'graphene',
+    'graphene_sqlalchemy',
+    'geoip2',
+    'maxminddb',
+)
+
+
+class LazyImportFinder:
+    """
+    Meta path finder wrapping loaders of selected modules into `LazyLoader`,
+    so that `import x` only creates a module object and its code runs
+    on the first attribute access.
+    """
+
+    def __init__(self, names: Iterable[str]):
+        self.names = frozenset(names)
+
+    def _is_lazy(self, fullname: str) -> bool:
+        return fullname.partition('.')[0] in self.names
+
+    def find_spec(self, fullname, path, target=None):
+        if not self._is_lazy(fullname):
+            return None
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        if spec.loader is None or not hasattr(spec.loader, 'exec_module'):
+            return spec
+        spec.loader = LazyLoader(spec.loader)
+        return spec
+
+
+def install_lazy_imports(names: Iterable[str] = DEFAULT_LAZY_MODULES) -> None:
+    # Compared by name, since this module may be imported both as `importing`
+    # (manage.py) and as `game_master.importing`.
+    if any(type(f).__name__ == LazyImportFinder.__name__ for f in sys.meta_path):
+        return
+    sys.meta_path.insert(0, LazyImportFinder(names))
+
+
+def lazy_imports_enabled() -> bool:
+    return os.environ.get(LAZY_IMPORTS_ENV, '').lower() in ('1', 'true', 'yes', 'on')
+
+
+def warm_up(modules: Iterable[str]) -> None:
+    """Import and fully execute given modules."""
+    for name in modules:
+        module = importlib.import_module(name)
+        # Any attribute access forces execution of lazily loaded module.
+        getattr(module, '__dict__')
+
+
+def profile_imports(module: str, prelude: str = '', python: str = sys.executable,
+                    env: dict = None) -> List[Tuple[str, int, int]]:
+    """
+    Import `module` in a clean interpreter with `-X importtime`,
+    after running `prelude` code.
+    Return list of (module name, self time, cumulative time) in microseconds,
+    ordered by cumulative time descending.
+    """
+    code = '%s\nimport %s' % (prelude, module)
+    result = subprocess.run(
+        [python, '-X', 'importtime', '-c', code],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        env=env, universal_newlines=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        try:
+            self_us, cumulative_us, name = line[len('import time:'):].split('|')
+            rows.append((name.strip(), int(self_us), int(cumulative_us)))
+        except ValueError:  # header line
+            continue
+    if result.returncode and not rows:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    rows.sort(key=lambda r: r[2], reverse=True)
+    return rows
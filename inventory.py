@@ -0,0 +1,182 @@
+# Bulk import and export of servers and geo locations inventories.
+from anthill.framework.db import db
+from game_master.models import GeoLocationRegion, GeoLocation, Server
+from typing import Callable, Dict, IO, Iterable, Iterator, List, NamedTuple, Tuple
+import itertools
+import json
+import csv
+import io
+
+BATCH_SIZE = 10000
+
+FORMATS = ('csv', 'ndjson')
+
+
+class Entity(NamedTuple):
+    model: type
+    fields: Tuple[str, ...]  # fields of inventory records
+    columns: Tuple[str, ...]  # table columns filled from fields
+    to_row: Callable[[dict], tuple]
+    select: Callable[[], list]  # column expressions, one per field
+
+
+def _point(record: dict) -> str:
+    """Geometry as EWKT, parsed by the database while loading the whole batch."""
+    lon, lat = record.get('lon'), record.get('lat')
+    if lon in (None, '') or lat in (None, ''):
+        return None
+    return 'SRID=4326;POINT(%s %s)' % (float(lon), float(lat))
+
+
+ENTITIES: Dict[str, Entity] = {
+    'regions': Entity(
+        GeoLocationRegion,
+        ('id', 'name'),
+        ('id', 'name'),
+        lambda r: (r.get('id'), r.get('name')),
+        lambda: [GeoLocationRegion.id, GeoLocationRegion.name],
+    ),
+    'geo_locations': Entity(
+        GeoLocation,
+        ('id', 'lon', 'lat', 'region_id', 'default'),
+        ('id', 'point', 'region_id', 'default'),
+        lambda r: (r.get('id'), _point(r), r.get('region_id'), r.get('default') or False),
+        lambda: [GeoLocation.id, db.func.ST_X(GeoLocation.point), db.func.ST_Y(GeoLocation.point),
+                 GeoLocation.region_id, GeoLocation.default],
+    ),
+    'servers': Entity(
+        Server,
+        ('id', 'name', 'location', 'geo_location_id', 'enabled', 'status', 'cpu_load', 'ram_usage'),
+        ('id', 'name', 'location', 'geo_location_id', 'enabled', 'status', 'cpu_load', 'ram_usage'),
+        lambda r: (r.get('id'), r.get('name'), r.get('location'), r.get('geo_location_id'),
+                   _bool(r.get('enabled', True)), r.get('status') or 'active',
+                   r.get('cpu_load') or 0.0, r.get('ram_usage') or 0.0),
+        lambda: [Server.id, Server.name, Server.location, Server.geo_location_id,
+                 Server.enabled, Server.status, Server.cpu_load, Server.ram_usage],
+    ),
+}
+
+
+def _bool(value) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 't', 'true', 'yes', 'y', 'on')
+    return bool(value)
+
+
+def _clean(value):
+    return None if value == '' else value
+
+
+def _export_value(value):
+    if value is None or isinstance(value, (int, float, bool)):
+        return value
+    return str(getattr(value, 'code', value))  # choices are exported by code
+
+
+def read_records(f: IO[str], fmt: str) -> Iterator[dict]:
+    if fmt == 'csv':
+        for record in csv.DictReader(f):
+            yield {k: _clean(v) for k, v in record.items()}
+    elif fmt == 'ndjson':
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+    else:
+        raise ValueError('Unsupported format: %s' % fmt)
+
+
+def _batches(iterable: Iterable, size: int) -> Iterator[List]:
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _is_postgres() -> bool:
+    return db.engine.dialect.name == 'postgresql'
+
+
+def _copy_rows(table, columns: Tuple[str, ...], rows: List[tuple]) -> None:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(['' if v is None else v for v in row])
+    buffer.seek(0)
+    sql = 'COPY %s (%s) FROM STDIN WITH (FORMAT csv)' % (
+        table.name, ', '.join('"%s"' % c for c in columns))
+    connection = db.session.connection().connection
+    with connection.cursor() as cursor:
+        cursor.copy_expert(sql, buffer)
+
+
+def _insert_rows(table, columns: Tuple[str, ...], rows: List[tuple]) -> None:
+    """Insert rows with multi-row INSERT statements, one per set of keys."""
+    with_id, without_id = [], []
+    for row in rows:
+        record = dict(zip(columns, row))
+        if record.get('id') is None:
+            record.pop('id', None)
+        for name, column in table.columns.items():
+            if name in record and isinstance(column.type, db.Boolean):
+                record[name] = _bool(record[name])
+        (with_id if 'id' in record else without_id).append(record)
+    for records in (with_id, without_id):
+        if records:
+            db.session.execute(table.insert().values(records))
+
+
+def _reset_sequence(table) -> None:
+    db.session.execute(
+        "SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+        "COALESCE((SELECT MAX(id) FROM {0}), 1))".format(table.name))
+
+
+def import_records(name: str, records: Iterable[dict], batch_size: int = BATCH_SIZE) -> int:
+    """
+    Load records into the entity table in batches, in one transaction.
+    Postgres is loaded with COPY, other databases with multi-row inserts.
+    Return number of loaded records.
+    """
+    entity = ENTITIES[name]
+    table = entity.model.__table__
+    postgres = _is_postgres()
+    count = 0
+    try:
+        for batch in _batches(records, batch_size):
+            rows = [entity.to_row(r) for r in batch]
+            if postgres and all(row[0] is not None for row in rows):
+                _copy_rows(table, entity.columns, rows)
+            else:
+                _insert_rows(table, entity.columns, rows)
+            count += len(rows)
+        if postgres:
+            _reset_sequence(table)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return count
+
+
+def export_records(name: str, f: IO[str], fmt: str, batch_size: int = BATCH_SIZE) -> int:
+    """Stream all entity rows to file. Return number of exported records."""
+    entity = ENTITIES[name]
+    query = db.session.query(*entity.select()).order_by(entity.model.id).yield_per(batch_size)
+    writer = None
+    if fmt == 'csv':
+        writer = csv.writer(f)
+        writer.writerow(entity.fields)
+    elif fmt != 'ndjson':
+        raise ValueError('Unsupported format: %s' % fmt)
+    count = 0
+    for row in query:
+        row = [_export_value(v) for v in row]
+        if writer is not None:
+            writer.writerow(['' if v is None else v for v in row])
+        else:
+            f.write(json.dumps(dict(zip(entity.fields, row))))
+            f.write('\n')
+        count += 1
+    return count
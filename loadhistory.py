@@ -0,0 +1,264 @@
+# In-memory history of server load reported by heartbeats.
+from anthill.framework.conf import settings
+from array import array
+from typing import Dict, List, Optional, Tuple
+import math
+import threading
+import time
+
+LOAD_HISTORY = getattr(settings, 'LOAD_HISTORY', {})
+
+RAW_SIZE = LOAD_HISTORY.get('RAW_SIZE', 256)
+# List of (bucket width in seconds, number of buckets kept).
+ROLLUPS = tuple(LOAD_HISTORY.get('ROLLUPS', ((60, 240), (900, 192))))
+EWMA_HALF_LIFE = LOAD_HISTORY.get('EWMA_HALF_LIFE', 60)  # seconds
+TREND_WINDOW = LOAD_HISTORY.get('TREND_WINDOW', 300)  # seconds
+PREDICTION_HORIZON = LOAD_HISTORY.get('PREDICTION_HORIZON', 60)  # seconds
+
+METRICS = ('cpu_load', 'ram_usage')
+
+_STALE = object()
+
+
+class RingBuffer:
+    """Fixed size buffer of (timestamp, value) pairs backed by arrays of doubles."""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.values = array('d', bytes(8 * capacity))
+        self.head = 0  # next position to write
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, timestamp: float, value: float) -> None:
+        self.timestamps[self.head] = timestamp
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def items(self, since: float = None) -> List[Tuple[float, float]]:
+        """Return stored pairs in chronological order."""
+        start = (self.head - self.count) % self.capacity
+        result = []
+        for i in range(self.count):
+            j = (start + i) % self.capacity
+            if since is None or self.timestamps[j] >= since:
+                result.append((self.timestamps[j], self.values[j]))
+        return result
+
+    def dump(self, writer) -> None:
+        items = self.items()
+        writer.write_array(array('d', (t for t, _ in items)))
+        writer.write_array(array('d', (v for _, v in items)))
+
+    def restore(self, reader) -> None:
+        for t, v in zip(reader.read_array(), reader.read_array()):
+            self.append(t, v)
+
+
+class Rollup:
+    """Downsampled series, keeping mean and max of each bucket."""
+
+    def __init__(self, width: float, size: int):
+        self.width = width
+        self.means = RingBuffer(size)
+        self.maxima = RingBuffer(size)
+        self._bucket = None
+        self._sum = self._count = 0
+        self._max = -math.inf
+
+    def _flush(self) -> None:
+        if self._count:
+            ts = self._bucket * self.width
+            self.means.append(ts, self._sum / self._count)
+            self.maxima.append(ts, self._max)
+        self._sum = self._count = 0
+        self._max = -math.inf
+
+    def add(self, timestamp: float, value: float) -> None:
+        bucket = int(timestamp // self.width)
+        if bucket != self._bucket:
+            self._flush()
+            self._bucket = bucket
+        self._sum += value
+        self._count += 1
+        self._max = max(self._max, value)
+
+    def items(self, since: float = None) -> List[Tuple[float, float, float]]:
+        """Return (bucket start, mean, max) of completed buckets."""
+        return [(ts, mean, mx) for (ts, mean), (_, mx)
+                in zip(self.means.items(since), self.maxima.items(since))]
+
+    def dump(self, writer) -> None:
+        writer.write_optional_int(self._bucket)
+        writer.write_float(self._sum)
+        writer.write_int(self._count)
+        writer.write_float(self._max if self._count else None)
+        self.means.dump(writer)
+        self.maxima.dump(writer)
+
+    def restore(self, reader) -> None:
+        self._bucket = reader.read_optional_int()
+        self._sum = reader.read_float()
+        self._count = reader.read_int()
+        maximum = reader.read_float()
+        self._max = -math.inf if maximum is None else maximum
+        self.means.restore(reader)
+        self.maxima.restore(reader)
+
+
+class MetricHistory:
+    def __init__(self):
+        self.raw = RingBuffer(RAW_SIZE)
+        self.rollups = [Rollup(width, size) for width, size in ROLLUPS]
+        self.ewma: Optional[float] = None
+        self._last_ts: Optional[float] = None
+
+    def add(self, timestamp: float, value: float) -> None:
+        if self.ewma is None:
+            self.ewma = value
+        else:
+            dt = max(timestamp - self._last_ts, 0.0)
+            alpha = 1 - 0.5 ** (dt / EWMA_HALF_LIFE)
+            self.ewma += alpha * (value - self.ewma)
+        self._last_ts = timestamp
+        self.raw.append(timestamp, value)
+        for rollup in self.rollups:
+            rollup.add(timestamp, value)
+
+    def dump(self, writer) -> None:
+        writer.write_float(self.ewma)
+        writer.write_float(self._last_ts)
+        self.raw.dump(writer)
+        writer.write_int(len(self.rollups))
+        for rollup in self.rollups:
+            writer.write_float(rollup.width)
+            rollup.dump(writer)
+
+    def restore(self, reader) -> None:
+        self.ewma = reader.read_float()
+        self._last_ts = reader.read_float()
+        self.raw.restore(reader)
+        rollups = {r.width: r for r in self.rollups}
+        for _ in range(reader.read_int()):
+            # Rollups configured differently since the snapshot are rebuilt from scratch.
+            rollup = rollups.get(reader.read_float()) or Rollup(1, 1)
+            rollup.restore(reader)
+
+    def trend(self, window: float = TREND_WINDOW) -> float:
+        """Least squares slope of raw samples in the window, per second."""
+        if self._last_ts is None:
+            return 0.0
+        points = self.raw.items(since=self._last_ts - window)
+        n = len(points)
+        if n < 2:
+            return 0.0
+        mean_t = sum(t for t, _ in points) / n
+        mean_v = sum(v for _, v in points) / n
+        var = sum((t - mean_t) ** 2 for t, _ in points)
+        if not var:
+            return 0.0
+        return sum((t - mean_t) * (v - mean_v) for t, v in points) / var
+
+    def predict(self, horizon: float = PREDICTION_HORIZON) -> Optional[float]:
+        if self.ewma is None:
+            return None
+        return self.ewma + self.trend() * horizon
+
+
+class ServerLoadHistory:
+    def __init__(self):
+        self.metrics = {name: MetricHistory() for name in METRICS}
+        self.lock = threading.Lock()
+        self._score = _STALE  # score for default horizon, as of the last sample
+
+    def record(self, timestamp: float, **values) -> None:
+        with self.lock:
+            for name, value in values.items():
+                self.metrics[name].add(timestamp, value)
+            self._score = self._predict(PREDICTION_HORIZON)
+
+    def _predict(self, horizon: float) -> Optional[float]:
+        predictions = [m.predict(horizon) for m in self.metrics.values()]
+        predictions = [p for p in predictions if p is not None]
+        return max(predictions) if predictions else None
+
+    def score(self, horizon: float = PREDICTION_HORIZON) -> Optional[float]:
+        """
+        Predicted load, the worst of all metrics. Lower is better.
+        Score for the default horizon is computed when a heartbeat is recorded,
+        since it is asked for every server on each room placement.
+        """
+        with self.lock:
+            if horizon != PREDICTION_HORIZON:
+                return self._predict(horizon)
+            if self._score is _STALE:
+                self._score = self._predict(horizon)
+            return self._score
+
+    def query(self, metric: str, resolution: float = None, since: float = None) -> dict:
+        """
+        Return history of the metric suitable for dashboards.
+        Raw samples are returned when `resolution` is not given,
+        otherwise the finest rollup with bucket width >= `resolution`.
+        """
+        history = self.metrics[metric]
+        with self.lock:
+            result = {
+                'metric': metric,
+                'ewma': history.ewma,
+                'trend': history.trend(),
+            }
+            if resolution is None:
+                result['resolution'] = None
+                result['points'] = [{'t': t, 'value': v} for t, v in history.raw.items(since)]
+                return result
+            rollups = [r for r in history.rollups if r.width >= resolution] or history.rollups[-1:]
+            rollup = rollups[0]
+            result['resolution'] = rollup.width
+            result['points'] = [{'t': t, 'mean': mean, 'max': mx}
+                                for t, mean, mx in rollup.items(since)]
+            return result
+
+
+class LoadHistoryRegistry:
+    def __init__(self):
+        self.servers: Dict[int, ServerLoadHistory] = {}
+
+    def get(self, server_id: int) -> Optional[ServerLoadHistory]:
+        return self.servers.get(server_id)
+
+    def record(self, server_id: int, timestamp: float = None, **values) -> None:
+        history = self.servers.get(server_id)
+        if history is None:
+            history = self.servers.setdefault(server_id, ServerLoadHistory())
+        history.record(timestamp or time.time(), **values)
+
+    def remove(self, server_id: int) -> None:
+        self.servers.pop(server_id, None)
+
+    def dump(self, writer) -> None:
+        servers = list(self.servers.items())
+        writer.write_int(len(servers))
+        for server_id, history in servers:
+            writer.write_int(server_id)
+            with history.lock:
+                writer.write_int(len(history.metrics))
+                for name, metric in history.metrics.items():
+                    writer.write_str(name)
+                    metric.dump(writer)
+
+    def restore(self, reader, created_at: float) -> None:
+        for _ in range(reader.read_int()):
+            history = self.servers.setdefault(reader.read_int(), ServerLoadHistory())
+            for _ in range(reader.read_int()):
+                name = reader.read_str()
+                metric = history.metrics.get(name) or MetricHistory()
+                metric.restore(reader)
+            history._score = _STALE
+
+
+load_history = LoadHistoryRegistry()
@@ -0,0 +1,198 @@
+# Non-blocking logging: records are written to files by a background thread.
+from logging.handlers import RotatingFileHandler
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+POLICIES = ('drop_new', 'drop_old')
+
+
+def _level(level) -> int:
+    return level if isinstance(level, int) else logging.getLevelName(level)
+
+
+class SamplingFilter(logging.Filter):
+    """Pass only `rate` part of records below `min_level`, e.g. access logs."""
+
+    def __init__(self, rate: float = 1.0, min_level=logging.WARNING, name=''):
+        super().__init__(name)
+        self.rate = rate
+        self.min_level = _level(min_level)
+
+    def filter(self, record):
+        return record.levelno >= self.min_level or random.random() < self.rate
+
+
+class BatchRotatingFileHandler(RotatingFileHandler):
+    """Rotating file handler writing many records with one write and flush."""
+
+    def emit_batch(self, records) -> None:
+        chunks = []
+        for record in records:
+            try:
+                chunks.append(self.format(record) + self.terminator)
+            except Exception:
+                self.handleError(record)
+        if not chunks:
+            return
+        data = ''.join(chunks)
+        with self.lock:
+            try:
+                if self.stream is None:
+                    self.stream = self._open()
+                if self.maxBytes > 0:
+                    self.stream.seek(0, 2)
+                    if self.stream.tell() and self.stream.tell() + len(data) >= self.maxBytes:
+                        self.doRollover()
+                        if self.stream is None:  # not reopened by rollover with delay
+                            self.stream = self._open()
+                self.stream.write(data)
+                self.stream.flush()
+            except Exception:
+                self.handleError(records[-1])
+
+
+class QueueRotatingFileHandler(logging.Handler):
+    """
+    Puts records into a bounded queue; a background thread writes them
+    to a rotating file in batches, so that callers (IOLoop thread) never
+    wait for disk writes or rotations.
+
+    When the queue is full records are dropped according to `policy`:
+    `drop_new` discards the incoming record, `drop_old` the oldest queued
+    one below `never_drop_level`. Records of `never_drop_level` and above
+    are never evicted, they wait for free space up to `block_timeout`
+    seconds instead. Number of dropped records is reported to the file
+    periodically.
+    """
+
+    def __init__(self, filename, mode='a', maxBytes=0, backupCount=0, encoding=None,
+                 capacity=10000, policy='drop_old', batch_size=256, flush_interval=0.5,
+                 never_drop_level=logging.ERROR, block_timeout=1.0):
+        super().__init__()
+        if policy not in POLICIES:
+            raise ValueError('Unknown drop policy: %s' % policy)
+        self.target = BatchRotatingFileHandler(
+            filename, mode=mode, maxBytes=maxBytes, backupCount=backupCount,
+            encoding=encoding, delay=True)
+        self.capacity = capacity
+        self.policy = policy
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.never_drop_level = _level(never_drop_level)
+        self.block_timeout = block_timeout
+        self.dropped = 0
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def setFormatter(self, fmt):
+        super().setFormatter(fmt)
+        self.target.setFormatter(fmt)
+
+    def _ensure_started(self) -> None:
+        # Writer thread does not survive fork (celery workers), so start it per process.
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(self.capacity)
+            self._thread = threading.Thread(
+                target=self._run, name='log-writer', daemon=True, args=(self._queue,))
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def prepare(self, record):
+        # Render message now, arguments may change before the record is written.
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def emit(self, record):
+        try:
+            self._ensure_started()
+            record = self.prepare(record)
+            try:
+                self._queue.put_nowait(record)
+                return
+            except queue.Full:
+                pass
+            if record.levelno >= self.never_drop_level:
+                self._queue.put(record, timeout=self.block_timeout)
+            elif self.policy == 'drop_old':
+                self._put_evicting(record)
+                self.dropped += 1
+            else:
+                self.dropped += 1
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def _put_evicting(self, record) -> None:
+        """
+        Put `record` in place of the oldest queued record below `never_drop_level`.
+        If there is none, `record` itself is dropped.
+        """
+        records = self._queue
+        with records.mutex:
+            if len(records.queue) >= records.maxsize:
+                for index, queued in enumerate(records.queue):
+                    if queued is not None and queued.levelno < self.never_drop_level:
+                        del records.queue[index]
+                        break
+                else:
+                    return
+            records.queue.append(record)
+            records.not_empty.notify()
+
+    def _report_dropped(self, batch) -> None:
+        dropped, self.dropped = self.dropped, 0
+        if dropped:
+            batch.append(logging.makeLogRecord({
+                'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                'msg': '%d log records dropped, queue is full.' % dropped,
+                'module': 'log', 'lineno': 0, 'created': time.time(),
+            }))
+
+    def _run(self, records: queue.Queue) -> None:
+        stop = False
+        while not stop:
+            batch = []
+            try:
+                record = records.get(timeout=self.flush_interval)
+                while True:
+                    if record is None:  # sentinel put by close()
+                        stop = True
+                        break
+                    batch.append(record)
+                    if len(batch) >= self.batch_size:
+                        break
+                    record = records.get_nowait()
+            except queue.Empty:
+                pass
+            self._report_dropped(batch)
+            if batch:
+                self.target.emit_batch(batch)
+
+    def flush(self):
+        if self._pid == os.getpid():
+            deadline = time.monotonic() + self.block_timeout
+            while not self._queue.empty() and time.monotonic() < deadline:
+                time.sleep(0.01)
+        self.target.flush()
+
+    def close(self):
+        if self._pid == os.getpid() and self._thread.is_alive():
+            try:
+                self._queue.put(None, timeout=self.block_timeout)
+            except queue.Full:
+                pass
+            self._thread.join(self.block_timeout * 5)
+        self.target.close()
+        super().close()
@@ -3,6 +3,9 @@ import os
 
 if __name__ == "__main__":
     os.environ.setdefault("ANTHILL_SETTINGS_MODULE", "settings")
+    from importing import install_lazy_imports, lazy_imports_enabled
+    if lazy_imports_enabled():
+        install_lazy_imports()
     try:
         import anthill.framework
         anthill.framework.setup()
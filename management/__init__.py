@@ -35,3 +35,252 @@ Example:
 from anthill.framework.core.management import Command, Option, Manager
 
 # Create your management commands here.
+from game_master.importing import profile_imports
+from game_master import forecasting
+from game_master.cache import ControllersStorage
+from game_master.log import QueueRotatingFileHandler
+from logging.handlers import RotatingFileHandler
+import datetime
+import tempfile
+import asyncio
+import logging
+import sys
+import time
+import csv
+import os
+
+
+class ImportProfile(Command):
+    help = 'Print import time per module.'
+    name = 'import_profile'
+
+    option_list = (
+        Option('-m', '--module', dest='module', default='game_master.models',
+               help='module to import.'),
+        Option('-n', '--limit', dest='limit', type=int, default=30,
+               help='number of modules to show.'),
+        Option('--lazy', dest='lazy', action='store_true', default=False,
+               help='enable lazy imports of heavy dependencies.'),
+    )
+
+    def run(self, module, limit, lazy):
+        prelude = (
+            'import anthill.framework\n'
+            'anthill.framework.setup()'
+        )
+        if lazy:
+            prelude = (
+                'from game_master.importing import install_lazy_imports\n'
+                'install_lazy_imports()\n'
+            ) + prelude
+        rows = profile_imports(module, prelude=prelude, env=os.environ.copy())
+        total = max((r[2] for r in rows), default=0)
+        print('%-60s %12s %12s' % ('module', 'self, ms', 'cumul, ms'))
+        for name, self_us, cumulative_us in rows[:limit]:
+            print('%-60s %12.1f %12.1f' % (name, self_us / 1000, cumulative_us / 1000))
+        print('Total: %.1f ms' % (total / 1000))
+
+
+class PrewarmReplay(Command):
+    help = (
+        'Replay recorded room requests trace with and without pre-warming. '
+        'Trace is a CSV file with timestamp, region_id, app_version_id columns.'
+    )
+    name = 'prewarm_replay'
+
+    option_list = (
+        Option('-t', '--trace', dest='trace', required=True,
+               help='path to the trace file.'),
+        Option('-w', '--train-weeks', dest='train_weeks', type=int, default=forecasting.HISTORY_WEEKS,
+               help='number of first weeks of the trace used for learning.'),
+        Option('-c', '--cold-start', dest='cold_start', type=float, default=forecasting.LEAD_TIME,
+               help='room startup time, seconds.'),
+    )
+
+    @staticmethod
+    def parse_timestamp(value):
+        try:
+            return float(value)
+        except ValueError:
+            return datetime.datetime.fromisoformat(value).timestamp()
+
+    def run(self, trace, train_weeks, cold_start):
+        with open(trace, newline='') as f:
+            events = [(self.parse_timestamp(row['timestamp']),
+                       int(row['region_id']) if row.get('region_id') else None,
+                       int(row['app_version_id']) if row.get('app_version_id') else None)
+                      for row in csv.DictReader(f)]
+        if not events:
+            print('Trace is empty.')
+            return
+        split_at = min(e[0] for e in events) + train_weeks * forecasting.WEEK
+        train = [e for e in events if e[0] < split_at]
+        test = [e for e in events if e[0] >= split_at]
+        forecaster = forecasting.DemandForecaster()
+        forecaster.fit(train)
+
+        print('Learned from %d requests, replaying %d requests.' % (len(train), len(test)))
+        print('%-16s %10s %10s %10s %10s' % ('', 'mean, s', 'p50, s', 'p95, s', 'p99, s'))
+        for title, model in (('cold start', None), ('pre-warmed', forecaster)):
+            waits = forecasting.replay(test, model, cold_start=cold_start)
+            mean = sum(waits) / len(waits) if waits else 0.0
+            print('%-16s %10.2f %10.2f %10.2f %10.2f' % (
+                title, mean, forecasting.percentile(waits, 50),
+                forecasting.percentile(waits, 95), forecasting.percentile(waits, 99)))
+
+
+class ControllersStorageBenchmark(Command):
+    help = 'Compare per key and bulk access to the controllers cache.'
+    name = 'bench_controllers_storage'
+
+    option_list = (
+        Option('-n', '--count', dest='count', type=int, default=1000,
+               help='number of controllers.'),
+    )
+
+    def run(self, count):
+        from anthill.framework.core.cache import caches
+        cache = caches['controllers']
+        storage = ControllersStorage(cache)
+        keys = ['bench:%d' % i for i in range(count)]
+        data = {k: {'status': 'active', 'cpu_load': 0.5} for k in keys}
+
+        def measure(title, round_trips, f):
+            started = time.perf_counter()
+            f()
+            elapsed = time.perf_counter() - started
+            print('%-24s %10d %12.2f' % (title, round_trips, elapsed * 1000))
+
+        print('%-24s %10s %12s' % ('operation', 'round trips', 'time, ms'))
+        measure('set, per key', count, lambda: [cache.set(k, v) for k, v in data.items()])
+        measure('set_many, pipelined', 1, lambda: storage.set_many(data))
+        measure('get, per key', count, lambda: [cache.get(k) for k in keys])
+        measure('get_many, MGET', 1, lambda: storage.get_many(keys))
+        versioned = storage.get_many_versioned(keys)
+        measure('compare_and_set_many', 1, lambda: storage.compare_and_set_many(
+            {k: (version, dict(v, status='overload')) for k, (v, version) in versioned.items()}))
+        measure('delete, per key', count, lambda: [cache.delete(k) for k in keys])
+        storage.set_many(data)
+        measure('delete_many', 1, lambda: storage.delete_many(keys))
+
+
+def _inventory_format(path, fmt):
+    if fmt:
+        return fmt
+    return 'ndjson' if path.endswith(('.ndjson', '.jsonl')) else 'csv'
+
+
+class ImportInventory(Command):
+    help = 'Bulk load servers, geo locations or regions from CSV or NDJSON file.'
+    name = 'import_inventory'
+
+    option_list = (
+        Option('-e', '--entity', dest='entity', required=True,
+               choices=('regions', 'geo_locations', 'servers'),
+               help='what to import.'),
+        Option('-i', '--input', dest='path', required=True,
+               help='path to the file, `-` for standard input.'),
+        Option('-f', '--format', dest='fmt', default=None, choices=('csv', 'ndjson'),
+               help='file format, guessed by extension by default.'),
+        Option('-b', '--batch-size', dest='batch_size', type=int, default=10000,
+               help='number of records loaded at once.'),
+    )
+
+    def run(self, entity, path, fmt, batch_size):
+        from game_master import inventory
+        fmt = _inventory_format(path, fmt)
+        started = time.perf_counter()
+        f = sys.stdin if path == '-' else open(path, newline='')
+        try:
+            count = inventory.import_records(entity, inventory.read_records(f, fmt), batch_size)
+        finally:
+            if f is not sys.stdin:
+                f.close()
+        print('Imported %d %s in %.2f s.' % (count, entity, time.perf_counter() - started))
+
+
+class ExportInventory(Command):
+    help = 'Dump servers, geo locations or regions to CSV or NDJSON file.'
+    name = 'export_inventory'
+
+    option_list = (
+        Option('-e', '--entity', dest='entity', required=True,
+               choices=('regions', 'geo_locations', 'servers'),
+               help='what to export.'),
+        Option('-o', '--output', dest='path', default='-',
+               help='path to the file, standard output by default.'),
+        Option('-f', '--format', dest='fmt', default=None, choices=('csv', 'ndjson'),
+               help='file format, guessed by extension by default.'),
+    )
+
+    def run(self, entity, path, fmt):
+        from game_master import inventory
+        fmt = _inventory_format(path, fmt)
+        f = sys.stdout if path == '-' else open(path, 'w', newline='')
+        try:
+            count = inventory.export_records(entity, f, fmt)
+        finally:
+            if f is not sys.stdout:
+                f.close()
+        print('Exported %d %s.' % (count, entity), file=sys.stderr)
+
+
+class LoggingBenchmark(Command):
+    help = 'Measure event loop lag caused by file logging, synchronous and queued.'
+    name = 'bench_logging'
+
+    option_list = (
+        Option('-n', '--records', dest='records', type=int, default=100000,
+               help='number of log records.'),
+        Option('-m', '--max-bytes', dest='max_bytes', type=int, default=10 * 1024 * 1024,
+               help='log file size to rotate at.'),
+    )
+
+    @staticmethod
+    async def measure(logger, records):
+        lags = []
+        done = False
+
+        async def ticker():
+            interval = 0.001
+            while not done:
+                expected = time.perf_counter() + interval
+                await asyncio.sleep(interval)
+                lags.append(max(time.perf_counter() - expected, 0))
+
+        ticker_task = asyncio.ensure_future(ticker())
+        started = time.perf_counter()
+        for i in range(records):
+            logger.info('GET /api/v1/rooms/%d 200 %.2fms', i, 1.5)
+            if i % 100 == 0:
+                await asyncio.sleep(0)  # let other callbacks run, as a busy server does
+        elapsed = time.perf_counter() - started
+        done = True
+        await ticker_task
+        return elapsed, lags
+
+    def run(self, records, max_bytes):
+        formatter = logging.Formatter('[%(levelname)1.1s %(asctime)s %(module)s:%(lineno)d] %(message)s')
+        print('%-24s %12s %10s %10s %10s' % ('handler', 'logging, s', 'lag p50', 'lag p99', 'lag max'))
+        with tempfile.TemporaryDirectory() as directory:
+            # Queue holds all records, so both handlers write every record.
+            for title, handler_class, options in (
+                    ('RotatingFileHandler', RotatingFileHandler, {}),
+                    ('QueueRotatingFileHandler', QueueRotatingFileHandler, {'capacity': records + 1})):
+                handler = handler_class(
+                    os.path.join(directory, '%s.log' % title), maxBytes=max_bytes, backupCount=2,
+                    **options)
+                handler.setFormatter(formatter)
+                logger = logging.getLogger('game_master.bench.%s' % title)
+                logger.propagate = False
+                logger.setLevel(logging.INFO)
+                logger.addHandler(handler)
+                try:
+                    elapsed, lags = asyncio.get_event_loop().run_until_complete(
+                        self.measure(logger, records))
+                finally:
+                    logger.removeHandler(handler)
+                    handler.close()
+                lags.sort()
+                p = lambda q: lags[min(int(q * len(lags)), len(lags) - 1)] * 1000 if lags else 0.0
+                print('%-24s %12.2f %8.2fms %8.2fms %8.2fms' % (title, elapsed, p(0.5), p(0.99), p(1.0)))
@@ -3,22 +3,23 @@
 from anthill.framework.db import db
 from anthill.framework.conf import settings
 from anthill.framework.utils import timezone
-from anthill.framework.utils.functional import cached_property
-from anthill.framework.utils.geoip import GeoIP2
 from anthill.framework.utils.asynchronous import as_future, thread_pool_exec as future_exec
 from anthill.framework.utils.translation import translate_lazy as _
 from anthill.platform.models import BaseApplication, BaseApplicationVersion
 from anthill.platform.api.internal import InternalAPIMixin, RequestError
 from anthill.platform.auth import RemoteUser
 from anthill.platform.services import HeartbeatReport
+from game_master.admission import admission_controlled, get_controller
+from game_master.patches import JSONPatchMixin
 from sqlalchemy_utils.types import URLType, ChoiceType, JSONType, IPAddressType
 from sqlalchemy.ext.hybrid import hybrid_property
 from geoalchemy2.elements import WKTElement
 from geoalchemy2 import Geometry
-from functools import partial, wraps
-from typing import Union
+from functools import partial, wraps, lru_cache
+from typing import Dict, Optional, Union
 import geoalchemy2.functions as func
 import traceback
+import asyncio
 import enum
 import json
 
@@ -40,7 +41,41 @@ class PlayersLimitPerRoomExceeded(Exception):
 
 
 class UserBannedError(Exception):
-    pass
+    def __init__(self, user_ids=None):
+        super().__init__(user_ids)
+        self.user_ids = user_ids or []
+
+
+@lru_cache(maxsize=None)
+def get_geoip():
+    """
+    Return GeoIP2 instance shared by all players.
+    Both geoip2 package import and database loading are deferred until first use.
+    """
+    if getattr(settings, 'GEOIP_PATH', None):
+        from anthill.framework.utils.geoip import GeoIP2
+        return GeoIP2()
+
+
+# server_id -> region_id of the server geo location, kept in memory for admission control.
+server_regions: Dict[int, Optional[int]] = {}
+
+
+def _room_admission_key(room: 'Room', *args, **kwargs):
+    return server_regions.get(room.server_id), room.app_version_id
+
+
+def _party_admission_key(party: 'Party', member: 'PartySession', *args, **kwargs):
+    return party.settings.get('region_id'), member.app_version_id
+
+
+async def broadcast(user_ids, data) -> None:
+    """Send the same message to all users at once."""
+    message = json.dumps(data)
+    await asyncio.gather(*[
+        RemoteUser.send_message_by_user_id(user_id, message=message, content_type='application/json')
+        for user_id in user_ids
+    ])
 
 
 class Application(BaseApplication):
@@ -54,8 +89,9 @@ class ApplicationVersion(BaseApplicationVersion):
     deployments = db.relationship('Deployment', backref='app_version', lazy='dynamic')
 
 
-class Room(InternalAPIMixin, db.Model):
+class Room(InternalAPIMixin, JSONPatchMixin, db.Model):
     __tablename__ = 'rooms'
+    json_patch_fields = ('settings',)
 
     id = db.Column(db.Integer, primary_key=True)
     server_id = db.Column(db.Integer, db.ForeignKey('servers.id'))
@@ -63,18 +99,34 @@ class Room(InternalAPIMixin, db.Model):
     players = db.relationship('Player', backref='room', lazy='dynamic')
     settings = db.Column(JSONType, nullable=False, default={})
     max_players_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=timezone.now, index=True)
+    # When the room was asked for, pre-warmed rooms get it only when claimed.
+    # Demand forecast learns from it.
+    demanded_at = db.Column(db.DateTime, default=timezone.now, index=True)
 
-    async def check_moderations(self):
-        # TODO: get moderations from moderation servce
-        if True:
-            raise UserBannedError
+    # noinspection PyMethodMayBeStatic
+    async def check_moderations(self, *user_ids):
+        from game_master.moderation import moderation_cache
+        banned = await moderation_cache.get_banned(user_ids)
+        if banned:
+            raise UserBannedError(sorted(banned))
 
+    @admission_controlled(get_controller('room.join'), _room_admission_key)
     async def join(self, player):
+        from game_master.sharding import router
+        if not router.is_local('room', self.id):
+            ip_address = player.ip_address and str(player.ip_address)
+            return await router.forward(
+                'room', self.id, 'room_join', room_id=self.id, user_id=player.user_id,
+                ip_address=ip_address, payload=player.payload)
+        await self.join_local(player)
+
+    async def join_local(self, player):
         players = await future_exec(self.players.all)
 
         if len(players) >= self.max_players_count:
             raise PlayersLimitPerRoomExceeded
-        await self.check_moderations()
+        await self.check_moderations(player.user_id)
 
         player.room_id = self.id
         await future_exec(self.players.append, player)
@@ -116,13 +168,21 @@ class Room(InternalAPIMixin, db.Model):
         # TODO: start room process on controller
         pass
 
+    @admission_controlled(get_controller('room.spawn'), _room_admission_key)
     async def spawn(self):
+        from game_master.sharding import router
+        if not router.is_local('room', self.id):
+            return await router.forward('room', self.id, 'room_spawn', room_id=self.id)
+        return await self.spawn_local()
+
+    async def spawn_local(self):
         result = await self.instantiate()
         return result
 
 
-class Player(InternalAPIMixin, db.Model):
+class Player(InternalAPIMixin, JSONPatchMixin, db.Model):
     __tablename__ = 'players'
+    json_patch_fields = ('payload',)
 
     class Statuses(enum.Enum):
         NEW = 1
@@ -139,10 +199,9 @@ class Player(InternalAPIMixin, db.Model):
         data = await self.internal_request('login', 'get_user', user_id=self.user_id)
         return RemoteUser(**data)
 
-    @cached_property
+    @property
     def gis(self):
-        if getattr(settings, 'GEOIP_PATH', None):
-            return GeoIP2()
+        return get_geoip()
 
     def get_location(self):
         """Return a tuple of the (latitude, longitude) for the given ip address."""
@@ -226,26 +285,76 @@ class Server(InternalAPIMixin, db.Model):
     def active(self):
         return self.enabled and self.status == 'active'
 
+    @classmethod
+    def get_active(cls, region_id=None):
+        query = cls.query.filter_by(enabled=True, status='active')
+        if region_id is not None:
+            query = query.join(GeoLocation).filter(GeoLocation.region_id == region_id)
+        return query.all()
+
+    @classmethod
+    def load_regions(cls) -> None:
+        rows = db.session.query(cls.id, GeoLocation.region_id).outerjoin(GeoLocation).all()
+        server_regions.clear()
+        server_regions.update(rows)
+
+    @property
+    def load_score(self) -> float:
+        """Predicted load based on recent heartbeats. Lower is better."""
+        from game_master.loadhistory import load_history
+        history = load_history.get(self.id)
+        score = history and history.score()
+        return max(self.cpu_load, self.ram_usage) if score is None else score
+
     @classmethod
     async def get_optimal(cls, region_id):
-        # TODO:
-        return cls.query.filter_by(active=True).first()
+        from game_master.failure_detector import failure_detector
+        servers = await future_exec(cls.get_active, region_id)
+        servers = [s for s in servers if not failure_detector.is_suspected(s.id)]
+        return min(servers, key=lambda s: s.load_score, default=None)
+
+    @classmethod
+    def catch_up_load_history(cls, since: float) -> None:
+        """Bring load history restored from snapshot up to date with the database."""
+        from game_master.loadhistory import load_history
+        rows = cls.query.with_entities(cls.id, cls.last_heartbeat, cls.cpu_load, cls.ram_usage).all()
+        for server_id in set(load_history.servers) - {row.id for row in rows}:
+            load_history.remove(server_id)
+        for server_id, last_heartbeat, cpu_load, ram_usage in rows:
+            if last_heartbeat is not None and last_heartbeat.timestamp() > since:
+                load_history.record(
+                    server_id, last_heartbeat.timestamp(), cpu_load=cpu_load, ram_usage=ram_usage)
 
     @as_future
     def heartbeat(self, report: Union[HeartbeatReport, RequestError]):
+        from game_master.loadhistory import load_history
+        from game_master.failure_detector import failure_detector
         if isinstance(report, RequestError):
             self.status = 'failed'
             self.last_failure_tb = traceback.format_tb(report.__traceback__)
+            failure_detector.suspect(self.id)
         elif isinstance(report, HeartbeatReport):
+            failure_detector.heartbeat(self.id)
+            if self.id not in server_regions:
+                server_regions[self.id] = self.geo_location and self.geo_location.region_id
             self.last_heartbeat = timezone.now()
             self.cpu_load = report.cpu_load
             self.ram_usage = report.ram_usage
+            load_history.record(
+                self.id, self.last_heartbeat.timestamp(),
+                cpu_load=report.cpu_load, ram_usage=report.ram_usage)
             self.status = 'overload' if report.is_overload() else 'active'
         else:
             raise ValueError('`report` argument should be either instance of'
                              'HeartbeatReport or RequestError')
         self.save()
 
+    @as_future
+    def mark_failed(self, reason: str):
+        self.status = 'failed'
+        self.last_failure_tb = reason
+        self.save()
+
 
 class Deployment(db.Model):
     __tablename__ = 'deployment'
@@ -255,8 +364,9 @@ class Deployment(db.Model):
     file = db.Column(db.FileType(upload_to='deployments'), nullable=False)
 
 
-class Party(db.Model):
+class Party(JSONPatchMixin, db.Model):
     __tablename__ = 'parties'
+    json_patch_fields = ('settings',)
 
     class Statuses(enum.Enum):
         CREATED = 1
@@ -269,6 +379,7 @@ class Party(db.Model):
     settings = db.Column(JSONType, nullable=False, default={})
 
     async def create_session(self, user_id: str, role=None, settings=None) -> 'PartySession':
+        from game_master.resume import party_events
         if self.members_count >= self.max_members_count:
             raise PlayersLimitPerPartyExceeded
 
@@ -279,7 +390,7 @@ class Party(db.Model):
             'settings': settings or {},
         }
         session = await future_exec(PartySession.create, **kwargs)
-        # TODO: all party members want to know that
+        await party_events.publish(self.id, {'type': 'member_joined', 'user_id': user_id})
 
         return session
 
@@ -290,10 +401,109 @@ class Party(db.Model):
         self.status = status
         self.save()
 
+    @admission_controlled(get_controller('party.start'), _party_admission_key)
     async def start(self, member: 'PartySession'):
-        await self.set_status(self.Statuses.STARTING)
-        # TODO: start server by member
-        await self.set_status(self.Statuses.STARTED)
+        from game_master.sharding import router
+        if not router.is_local('party', self.id):
+            return await router.forward(
+                'party', self.id, 'party_start', party_id=self.id, member_id=member.id)
+        await self.start_local(member)
+
+    def reserve_room(self, members, app_version_id, room_id=None, server_id=None):
+        """
+        Mark party as starting and reserve slots for all members in one transaction.
+        Lock the room with `room_id` or create a new one on server with `server_id`,
+        then insert players of all members in one statement.
+        Return tuple of (room, created), or (None, False) if the room with `room_id`
+        is gone or has not enough free slots.
+        """
+        session = db.session
+        try:
+            starting = Party.query \
+                .filter_by(id=self.id, status=self.Statuses.CREATED) \
+                .update({'status': self.Statuses.STARTING}, synchronize_session=False)
+            if not starting:
+                raise PartyError('Party is already started')
+            created = room_id is None
+            if created:
+                if server_id is None:
+                    raise PartyError('No servers available')
+                room = Room(server_id=server_id, app_version_id=app_version_id,
+                            max_players_count=max(len(members), self.max_members_count))
+                session.add(room)
+                session.flush()
+            else:
+                room = Room.query.with_for_update().get(room_id)
+                if room is None or (Player.query.filter_by(room_id=room.id).count() +
+                                    len(members) > room.max_players_count):
+                    session.rollback()
+                    return None, False
+                room.demanded_at = timezone.now()
+            session.execute(Player.__table__.insert().values([
+                {'user_id': m.user_id, 'room_id': room.id, 'status': Player.Statuses.NEW, 'payload': {}}
+                for m in members
+            ]))
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        self.status = self.Statuses.STARTING
+        return room, created
+
+    def release_room(self, room, members, created):
+        """Undo `reserve_room`, so that the party can be started again."""
+        session = db.session
+        try:
+            Player.query \
+                .filter(Player.room_id == room.id, Player.user_id.in_([m.user_id for m in members])) \
+                .delete(synchronize_session=False)
+            if created:
+                Room.query.filter_by(id=room.id).delete(synchronize_session=False)
+            Party.query \
+                .filter_by(id=self.id, status=self.Statuses.STARTING) \
+                .update({'status': self.Statuses.CREATED}, synchronize_session=False)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        self.status = self.Statuses.CREATED
+
+    async def start_local(self, member: 'PartySession'):
+        from game_master.moderation import moderation_cache
+        from game_master.forecasting import prewarmer
+        members = await future_exec(self.members.all)
+        user_ids = [m.user_id for m in members]
+        banned = await moderation_cache.get_banned(user_ids)
+        if banned:
+            raise UserBannedError(sorted(banned))
+
+        region_id = self.settings.get('region_id')
+        app_version_id = member.app_version_id
+        room, created = None, False
+        room_id = prewarmer.claim(region_id, app_version_id)
+        if room_id is not None:
+            room, created = await future_exec(
+                self.reserve_room, members, app_version_id, room_id)
+        if room is None:  # no warm room, or it is gone or too small
+            server = await Server.get_optimal(region_id)
+            room, created = await future_exec(
+                self.reserve_room, members, app_version_id, None, server and server.id)
+
+        try:
+            if created:
+                await room.spawn()
+            await self.set_status(self.Statuses.STARTED)
+        except Exception:
+            await future_exec(self.release_room, room, members, created)
+            raise
+
+        server = await future_exec(getattr, room, 'server')
+        await broadcast(user_ids, {
+            'type': 'party_started',
+            'party_id': self.id,
+            'room_id': room.id,
+            'server': str(server.location),
+        })
 
     async def __start_server__(self, member: 'PartySession'):
         # TODO: spawn and join server
@@ -309,7 +519,9 @@ class Party(db.Model):
         pass
 
     async def close(self) -> None:
-        pass
+        from game_master.resume import party_events, session_resumer
+        await session_resumer.discard(self.id)
+        await party_events.drop(self.id)
 
     @hybrid_property
     def members(self):
@@ -335,8 +547,9 @@ def _check_permission(perm: 'PartySession.Permissions'):
     return decorator
 
 
-class PartySession(InternalAPIMixin, db.Model):
+class PartySession(InternalAPIMixin, JSONPatchMixin, db.Model):
     __tablename__ = 'party_sessions'
+    json_patch_fields = ('settings',)
 
     class Roles(enum.Enum):
         ADMIN = 1000
@@ -381,7 +594,9 @@ class PartySession(InternalAPIMixin, db.Model):
         await self.party.join_server(self)
 
     async def close(self, code=None, reason=None) -> None:
-        # TODO: all party members want to know that
+        from game_master.resume import party_events, session_resumer
+        await session_resumer.discard(self.party_id, self.id)
         await future_exec(self.delete)
+        await party_events.publish(self.party_id, {'type': 'member_left', 'user_id': self.user_id})
 
     leave_party = close
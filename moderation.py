@@ -0,0 +1,144 @@
+# In-memory view of the moderation service, used on the room join path.
+from anthill.framework.conf import settings
+from anthill.framework.utils.asynchronous import thread_pool_exec as future_exec
+from anthill.platform.api.internal import InternalAPIMixin
+from array import array
+from typing import Dict, Iterable, Optional, Set
+import logging
+import math
+import time
+
+logger = logging.getLogger('anthill.application')
+
+MODERATION_CACHE = getattr(settings, 'MODERATION_CACHE', {})
+
+SYNC_INTERVAL = MODERATION_CACHE.get('SYNC_INTERVAL', 60)
+MAX_STALENESS = MODERATION_CACHE.get('MAX_STALENESS', 5 * SYNC_INTERVAL)
+NEGATIVE_TTL = MODERATION_CACHE.get('NEGATIVE_TTL', 30)
+NEGATIVE_MAX_SIZE = MODERATION_CACHE.get('NEGATIVE_MAX_SIZE', 100000)
+RETRY_DELAY = MODERATION_CACHE.get('RETRY_DELAY', 5)
+FAIL_OPEN = MODERATION_CACHE.get('FAIL_OPEN', True)
+
+
+class ModerationUnavailable(Exception):
+    pass
+
+
+class ModerationCache(InternalAPIMixin):
+    """
+    Answers "is this user banned" from memory.
+
+    The full set of active bans is pulled from the moderation service
+    every `SYNC_INTERVAL` seconds into a dict, which is built in the thread
+    pool and swapped in on the IOLoop.
+    If the local copy gets older than `MAX_STALENESS` (moderation service
+    unreachable), lookups fall back to remote requests whose negative
+    results are remembered for `NEGATIVE_TTL` seconds.
+
+    If remote requests fail too, remote lookups are paused for
+    `RETRY_DELAY` seconds. Meanwhile with `FAIL_OPEN` lookups are answered
+    from the stale local copy, otherwise `ModerationUnavailable` is raised.
+    """
+
+    def __init__(self):
+        self.bans: Dict[int, Optional[float]] = {}  # user_id -> finish timestamp
+        self.synced_at: Optional[float] = None
+        # user_id -> expiration timestamp, in order of expiration
+        self._negative: Dict[int, float] = {}
+        self._retry_at = 0.0
+
+    @property
+    def is_fresh(self) -> bool:
+        return self.synced_at is not None and time.monotonic() - self.synced_at < MAX_STALENESS
+
+    @staticmethod
+    def _build(bans: Iterable[dict]) -> Dict[int, Optional[float]]:
+        return {int(b['user_id']): b.get('finish_at') for b in bans}
+
+    def _swap(self, bans: Dict[int, Optional[float]]) -> None:
+        self.bans = bans
+        self._negative.clear()
+        self._retry_at = 0.0
+        self.synced_at = time.monotonic()
+
+    def load(self, bans: Iterable[dict]) -> None:
+        """Replace local state with the given list of bans."""
+        self._swap(self._build(bans))
+
+    def dump(self, writer) -> None:
+        synced_at = None
+        if self.synced_at is not None:
+            synced_at = time.time() - (time.monotonic() - self.synced_at)
+        writer.write_float(synced_at)
+        writer.write_array(array('q', self.bans.keys()))
+        writer.write_array(array('d', (math.nan if f is None else f for f in self.bans.values())))
+
+    def restore(self, reader, created_at: float) -> None:
+        synced_at = reader.read_float()
+        user_ids, finish = reader.read_array(), reader.read_array()
+        self.load({'user_id': u, 'finish_at': None if math.isnan(f) else f}
+                  for u, f in zip(user_ids, finish))
+        self.synced_at = None
+        if synced_at is not None:
+            self.synced_at = time.monotonic() - (time.time() - synced_at)
+
+    async def sync(self) -> None:
+        try:
+            bans = await self.internal_request('moderation', 'get_active_bans')
+        except Exception:
+            logger.exception('Cannot sync moderation cache.')
+        else:
+            self._swap(await future_exec(self._build, bans))
+
+    def _is_banned_locally(self, user_id: int, now: float) -> bool:
+        finish_at = self.bans.get(user_id, 0)
+        return finish_at is None or finish_at > now
+
+    def _remember_negative(self, user_ids: Iterable[int], now: float) -> None:
+        expires_at = now + NEGATIVE_TTL
+        for user_id in user_ids:
+            self._negative.pop(user_id, None)
+            self._negative[user_id] = expires_at
+        while self._negative:
+            user_id = next(iter(self._negative))
+            if len(self._negative) <= NEGATIVE_MAX_SIZE and self._negative[user_id] > now:
+                break
+            del self._negative[user_id]
+
+    async def _fetch_banned(self, user_ids: Set[int]) -> Set[int]:
+        now = time.monotonic()
+        user_ids = {u for u in user_ids if self._negative.get(u, 0) <= now}
+        if not user_ids:
+            return set()
+        if now < self._retry_at:
+            return self._fallback(user_ids)
+        try:
+            bans = await self.internal_request(
+                'moderation', 'get_active_bans', user_ids=list(user_ids))
+        except Exception:
+            logger.exception('Cannot get bans from moderation service.')
+            self._retry_at = time.monotonic() + RETRY_DELAY
+            return self._fallback(user_ids)
+        banned = {int(b['user_id']) for b in bans}
+        self._remember_negative(user_ids - banned, now)
+        return banned
+
+    def _fallback(self, user_ids: Set[int]) -> Set[int]:
+        if not FAIL_OPEN:
+            raise ModerationUnavailable
+        now = time.time()
+        return {u for u in user_ids if self._is_banned_locally(u, now)}
+
+    async def get_banned(self, user_ids: Iterable[int]) -> Set[int]:
+        """Return subset of `user_ids` which are currently banned."""
+        user_ids = set(map(int, user_ids))
+        if self.is_fresh:
+            now = time.time()
+            return {u for u in user_ids if self._is_banned_locally(u, now)}
+        return await self._fetch_banned(user_ids)
+
+    async def is_banned(self, user_id: int) -> bool:
+        return bool(await self.get_banned([user_id]))
+
+
+moderation_cache = ModerationCache()
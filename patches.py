@@ -0,0 +1,252 @@
+# Partial updates of JSON columns with JSON patch (RFC 6902) operations.
+from anthill.framework.db import db
+from anthill.framework.conf import settings
+from anthill.framework.utils.asynchronous import thread_pool_exec as future_exec
+from sqlalchemy import cast, func, literal
+from sqlalchemy.dialects.postgresql import JSON, JSONB, ARRAY
+from sqlalchemy.orm.attributes import set_committed_value
+from typing import Any, Dict, List, Optional, Tuple
+import asyncio
+import copy
+import json
+
+JSON_PATCH = getattr(settings, 'JSON_PATCH', {})
+
+COALESCE_DELAY = JSON_PATCH.get('COALESCE_DELAY', 0.05)  # seconds
+
+OPERATIONS = ('add', 'remove', 'replace')
+
+
+class JSONPatchError(Exception):
+    pass
+
+
+def parse_pointer(pointer: str) -> List[str]:
+    if pointer == '':
+        return []
+    if not pointer.startswith('/'):
+        raise JSONPatchError('Invalid path: %s' % pointer)
+    return [p.replace('~1', '/').replace('~0', '~') for p in pointer[1:].split('/')]
+
+
+def _is_index(segment: str) -> bool:
+    return segment == '-' or segment.isdigit()
+
+
+def validate(operations: List[dict]) -> List[dict]:
+    for operation in operations:
+        if operation.get('op') not in OPERATIONS:
+            raise JSONPatchError('Unsupported operation: %s' % operation.get('op'))
+        if 'path' not in operation:
+            raise JSONPatchError('Operation path is missing')
+        if operation['op'] != 'remove' and 'value' not in operation:
+            raise JSONPatchError('Operation value is missing')
+        parse_pointer(operation['path'])
+    return operations
+
+
+def apply_patch(document: Any, operations: List[dict]) -> Any:
+    """Apply operations to a copy of the document."""
+    document = copy.deepcopy(document)
+    for operation in operations:
+        path = parse_pointer(operation['path'])
+        op = operation['op']
+        if not path:
+            if op == 'remove':
+                raise JSONPatchError('Cannot remove the document root')
+            document = copy.deepcopy(operation['value'])
+            continue
+        parent = document
+        try:
+            for segment in path[:-1]:
+                parent = parent[int(segment)] if isinstance(parent, list) else parent[segment]
+            key = path[-1]
+            if isinstance(parent, list):
+                index = len(parent) if key == '-' else int(key)
+                if op == 'add':
+                    parent.insert(index, copy.deepcopy(operation['value']))
+                elif op == 'replace':
+                    parent[index] = copy.deepcopy(operation['value'])
+                else:
+                    del parent[index]
+            else:
+                if op == 'add':
+                    parent[key] = copy.deepcopy(operation['value'])
+                elif op == 'replace':
+                    if key not in parent:
+                        raise KeyError(key)
+                    parent[key] = copy.deepcopy(operation['value'])
+                else:
+                    del parent[key]
+        except (KeyError, IndexError, ValueError, TypeError):
+            raise JSONPatchError('Path not found: %s' % operation['path'])
+    return document
+
+
+def coalesce(operations: List[dict]) -> List[dict]:
+    """
+    Drop operations overwritten by later ones on the same path or its ancestor.
+    Operations on paths through array items never overwrite others, since
+    positions may shift, but they are overwritten along with their ancestors.
+    """
+    result = []
+    for operation in operations:
+        path = parse_pointer(operation['path'])
+        op = operation['op']
+        if any(map(_is_index, path)):
+            result.append(operation)
+            continue
+        kept = []
+        for o in result:
+            o_path = parse_pointer(o['path'])
+            overwritten = o_path[:len(path)] == path
+            # The value at the path may exist only thanks to the earlier operation,
+            # so it's kept for removal, and replace turns into add.
+            if not overwritten or op == 'remove' and o_path == path:
+                kept.append(o)
+            elif op == 'replace' and o_path == path:
+                operation = dict(operation, op='add')
+        kept.append(operation)
+        result = kept
+    return result
+
+
+def _path(segments: List[str]):
+    return literal(segments, ARRAY(db.Text))
+
+
+def _parent(document: Any, path: List[str]) -> Any:
+    for segment in path[:-1]:
+        document = document[int(segment)] if isinstance(document, list) else document[segment]
+    return document
+
+
+def to_sql(column, operations: List[dict], document: Any):
+    """
+    Postgres expression applying operations to the JSON column with jsonb functions.
+    `document` is the current value of the column, operations must be valid for it.
+    Adding to arrays and to objects is told apart by the container in the document,
+    since keys of objects may look like array indices.
+    """
+    expr = cast(column, JSONB)
+    for operation in operations:
+        path = parse_pointer(operation['path'])
+        op = operation['op']
+        if op != 'remove':
+            value = cast(literal(json.dumps(operation['value'])), JSONB)
+        if not path:
+            expr = value
+        elif op == 'remove':
+            expr = expr.op('#-', return_type=JSONB)(_path(path))
+        elif op == 'add' and isinstance(_parent(document, path), list):
+            if path[-1] == '-':
+                expr = func.jsonb_insert(expr, _path(path[:-1] + ['-1']), value, True, type_=JSONB)
+            else:
+                expr = func.jsonb_insert(expr, _path(path), value, type_=JSONB)
+        else:
+            expr = func.jsonb_set(expr, _path(path), value, op == 'add', type_=JSONB)
+        document = apply_patch(document, [operation])
+    return cast(expr, JSON)
+
+
+class JSONPatchMixin:
+    """
+    Adds partial updates of JSON columns listed in `json_patch_fields`.
+    Patches coming in quick succession are coalesced and written together.
+    Both on Postgres, where patches are applied with jsonb functions, and
+    elsewhere patches are checked against the current value first, so
+    errors follow RFC 6902 the same way.
+    """
+    json_patch_fields: Tuple[str, ...] = ()
+
+    def _check_field(self, field: str) -> None:
+        if field not in self.json_patch_fields:
+            raise JSONPatchError('Field `%s` cannot be patched' % field)
+
+    def apply_json_patches(self, field: str, patches: List[List[dict]]) -> List[Optional[JSONPatchError]]:
+        """
+        Check each patch against the current value, locked in the database,
+        and write all valid ones with one statement. Patches are applied in order,
+        an invalid one is skipped as a whole. Return list of errors, None for
+        applied patches.
+        """
+        self._check_field(field)
+        model = type(self)
+        column = getattr(model, field)
+        errors, operations = [], []
+        try:
+            document = model.query.with_entities(column).filter_by(id=self.id).with_for_update().scalar()
+            original = document
+            for patch in patches:
+                try:
+                    document = apply_patch(document, validate(patch))
+                except JSONPatchError as e:
+                    errors.append(e)
+                else:
+                    errors.append(None)
+                    operations.extend(patch)
+            if operations:
+                if db.engine.dialect.name == 'postgresql':
+                    value = to_sql(column, coalesce(operations), original)
+                else:
+                    value = document
+                model.query.filter_by(id=self.id).update({column: value}, synchronize_session=False)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        set_committed_value(self, field, document)
+        return errors
+
+    def apply_json_patch(self, field: str, operations: List[dict]) -> None:
+        """Write the patch to the database and update the loaded value."""
+        error, = self.apply_json_patches(field, [operations])
+        if error is not None:
+            raise error
+
+    async def patch_json(self, field: str, operations: List[dict]) -> None:
+        self._check_field(field)
+        validate(operations)
+        await coalescer.add(self, field, operations)
+
+
+class PatchCoalescer:
+    """
+    Collects patches of the same field coming in quick succession and writes
+    them together. Each caller gets its own result, an invalid patch fails
+    only the caller that sent it.
+    """
+
+    def __init__(self, delay: float = COALESCE_DELAY):
+        self.delay = delay
+        self.pending: Dict[tuple, tuple] = {}  # key -> (instance, patches, futures)
+
+    def add(self, instance: JSONPatchMixin, field: str, operations: List[dict]) -> asyncio.Future:
+        loop = asyncio.get_event_loop()
+        key = (type(instance), instance.id, field)
+        future = loop.create_future()
+        if key not in self.pending:
+            self.pending[key] = (instance, [], [])
+            loop.call_later(self.delay, lambda: asyncio.ensure_future(self.flush(key)))
+        _, patches, futures = self.pending[key]
+        patches.append(operations)
+        futures.append(future)
+        return future
+
+    async def flush(self, key: tuple) -> None:
+        instance, patches, futures = self.pending.pop(key)
+        field = key[2]
+        try:
+            errors = await future_exec(instance.apply_json_patches, field, patches)
+        except Exception as e:
+            errors = [e] * len(futures)
+        for future, error in zip(futures, errors):
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(None)
+
+
+coalescer = PatchCoalescer()
@@ -0,0 +1,277 @@
+# Party events buffering and resumable party sessions.
+from anthill.framework.conf import settings
+from anthill.framework.utils.asynchronous import thread_pool_exec as future_exec
+from tornado.ioloop import IOLoop
+from collections import OrderedDict, deque
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import secrets
+import logging
+
+logger = logging.getLogger('anthill.application')
+
+PARTY_SESSIONS = getattr(settings, 'PARTY_SESSIONS', {})
+
+RESUME_GRACE = PARTY_SESSIONS.get('RESUME_GRACE', 30)  # seconds
+EVENT_BUFFER_SIZE = PARTY_SESSIONS.get('EVENT_BUFFER_SIZE', 256)
+MAX_BUFFERS = PARTY_SESSIONS.get('MAX_BUFFERS', 10000)
+
+Event = Tuple[int, dict]  # (sequence number, event)
+
+
+def _router():
+    from game_master.sharding import router
+    return router
+
+
+async def _on_owner(party_id: int, method: str, local: Callable, **kwargs):
+    """
+    Run `local` on the node owning the party: directly if it is this node,
+    otherwise through internal api `method` of the owner.
+    """
+    router = _router()
+    if router.is_local('party', party_id):
+        return local(party_id, **kwargs)
+    return await router.forward('party', party_id, method, party_id=party_id, **kwargs)
+
+
+class PartyEventBuffer:
+    """Last events of the party, numbered with increasing sequence numbers."""
+
+    def __init__(self, size: int = EVENT_BUFFER_SIZE):
+        self.events = deque(maxlen=size)
+        self.last_seq = 0
+
+    def append(self, event: dict) -> int:
+        self.last_seq += 1
+        self.events.append((self.last_seq, event))
+        return self.last_seq
+
+    def since(self, seq: int) -> Optional[List[Event]]:
+        """Events after `seq`, or None if some of them are already dropped."""
+        first_seq = self.events[0][0] if self.events else self.last_seq + 1
+        if seq + 1 < first_seq:
+            return None
+        return [(s, e) for s, e in self.events if s > seq]
+
+
+class PartyEvents:
+    """
+    Party events, numbered and buffered by the node owning the party.
+
+    Events published on any node are sent to the owner, which numbers them
+    and delivers them to subscribers on every node, so party members
+    connected to different nodes see the same sequence. Subscribers are
+    local callbacks of connections of this node.
+    """
+
+    def __init__(self, max_buffers: int = MAX_BUFFERS):
+        self.max_buffers = max_buffers
+        self.buffers: Dict[int, PartyEventBuffer] = OrderedDict()  # parties owned by this node
+        self.subscribers: Dict[int, List[Callable[[int, dict], Any]]] = {}
+
+    def get(self, party_id: int) -> PartyEventBuffer:
+        buffer = self.buffers.get(party_id)
+        if buffer is None:
+            if len(self.buffers) >= self.max_buffers:
+                self.buffers.popitem(last=False)
+            buffer = self.buffers[party_id] = PartyEventBuffer()
+        else:
+            self.buffers.move_to_end(party_id)
+        return buffer
+
+    def deliver(self, party_id: int, seq: int, event: dict) -> None:
+        """Pass the event to subscribers of this node."""
+        for callback in list(self.subscribers.get(party_id, ())):
+            callback(seq, event)
+
+    async def publish(self, party_id: int, event: dict) -> int:
+        return await _on_owner(party_id, 'party_event_publish', self.publish_local, event=event)
+
+    def publish_local(self, party_id: int, event: dict) -> int:
+        seq = self.get(party_id).append(event)
+        self.deliver(party_id, seq, event)
+        router = _router()
+        if router.enabled:
+            for node in router.ring.nodes - {router.node}:
+                IOLoop.current().spawn_callback(self._deliver_remote, node, party_id, seq, event)
+        return seq
+
+    @staticmethod
+    async def _deliver_remote(node: str, party_id: int, seq: int, event: dict) -> None:
+        try:
+            await _router().internal_request(
+                node, 'party_event_deliver', party_id=party_id, seq=seq, event=event)
+        except Exception:
+            logger.exception('Cannot deliver party %s event to %s.', party_id, node)
+
+    async def last_seq(self, party_id: int) -> int:
+        return await _on_owner(party_id, 'party_events_last_seq', self.last_seq_local)
+
+    def last_seq_local(self, party_id: int) -> int:
+        return self.get(party_id).last_seq
+
+    async def subscribe(self, party_id: int, callback, since: int) -> Optional[List[Event]]:
+        """
+        Subscribe to new events and return events missed after `since`.
+        Events published meanwhile may be both passed to `callback` and returned.
+        """
+        self.subscribers.setdefault(party_id, []).append(callback)
+        return await _on_owner(party_id, 'party_events_since', self.since_local, since=since)
+
+    def since_local(self, party_id: int, since: int) -> Optional[List[Event]]:
+        return self.get(party_id).since(since)
+
+    def unsubscribe(self, party_id: int, callback) -> None:
+        callbacks = self.subscribers.get(party_id)
+        if callbacks is not None and callback in callbacks:
+            callbacks.remove(callback)
+            if not callbacks:
+                del self.subscribers[party_id]
+
+    async def drop(self, party_id: int) -> None:
+        await _on_owner(party_id, 'party_events_drop', self.drop_local)
+
+    def drop_local(self, party_id: int) -> None:
+        self.buffers.pop(party_id, None)
+
+
+class ResumeState:
+    __slots__ = ('session_id', 'user_id', 'node', 'acked_seq', 'timeout')
+
+    def __init__(self, session_id: int, user_id, node: Optional[str], acked_seq: int = 0):
+        self.session_id = session_id
+        self.user_id = user_id
+        self.node = node  # node the session is attached to, None if suspended
+        self.acked_seq = acked_seq
+        self.timeout = None
+
+
+class SessionResumer:
+    """
+    Keeps party sessions of disconnected clients for `RESUME_GRACE` seconds.
+    A client reconnecting with its resume token gets the same session back,
+    taking it over from the previous connection if that is still open.
+
+    Resume state is kept by the node owning the party, the token carries
+    the party id, so the client may reconnect to any node. Connections
+    are kept by the nodes they are open on.
+    """
+
+    def __init__(self, grace: float = RESUME_GRACE):
+        self.grace = grace
+        self.states: Dict[str, ResumeState] = {}  # sessions of parties owned by this node
+        self.handlers: Dict[str, Any] = {}  # connections open on this node
+
+    @staticmethod
+    def party_id(token: str) -> Optional[int]:
+        try:
+            return int(token.split('.', 1)[0])
+        except ValueError:
+            return None
+
+    async def issue(self, session, handler) -> str:
+        token = '%s.%s' % (session.party_id, secrets.token_urlsafe(24))
+        self.handlers[token] = handler
+        await _on_owner(session.party_id, 'party_session_issue', self.issue_local,
+                        token=token, session_id=session.id, user_id=session.user_id,
+                        node=_router().node)
+        return token
+
+    def issue_local(self, party_id: int, token: str, session_id: int, user_id, node) -> None:
+        self.states[token] = ResumeState(session_id, user_id, node)
+
+    async def suspend(self, token: str, acked_seq: int, handler) -> None:
+        """Start grace period, the session is closed when it ends."""
+        if self.handlers.get(token) is not handler:  # taken over by another connection
+            return
+        del self.handlers[token]
+        await _on_owner(self.party_id(token), 'party_session_suspend', self.suspend_local,
+                        token=token, acked_seq=acked_seq, node=_router().node)
+
+    def suspend_local(self, party_id: int, token: str, acked_seq: int, node) -> None:
+        state = self.states.get(token)
+        if state is None or state.node != node:  # discarded or taken over on another node
+            return
+        state.node = None
+        state.acked_seq = acked_seq
+        io_loop = IOLoop.current()
+        state.timeout = io_loop.call_later(
+            self.grace, lambda: io_loop.spawn_callback(self._expire, token))
+
+    async def _expire(self, token: str) -> None:
+        from game_master.models import PartySession
+        state = self.states.pop(token, None)
+        if state is None:
+            return
+        try:
+            session = await future_exec(PartySession.query.get, state.session_id)
+            if session is not None:
+                await session.close()
+        except Exception:
+            logger.exception('Cannot close party session %s.', state.session_id)
+
+    async def resume(self, token: str, user_id, handler) -> Optional[Tuple[int, int]]:
+        """
+        Attach the session of `user_id` to `handler`.
+        Return tuple of (session id, acknowledged sequence number),
+        None if token is unknown or belongs to another user.
+        """
+        party_id = self.party_id(token)
+        if party_id is None:
+            return None
+        resumed = await _on_owner(party_id, 'party_session_resume', self.resume_local,
+                                  token=token, user_id=user_id, node=_router().node)
+        if resumed is None:
+            return None
+        session_id, acked_seq, previous_node = resumed
+        if previous_node is not None:
+            # Client reconnected before the old connection was closed.
+            previous_acked_seq = await self._take_over(previous_node, token)
+            if previous_acked_seq is not None:
+                acked_seq = previous_acked_seq
+        self.handlers[token] = handler
+        return session_id, acked_seq
+
+    def resume_local(self, party_id: int, token: str, user_id, node) -> Optional[Tuple[int, int, Any]]:
+        state = self.states.get(token)
+        if state is None or str(state.user_id) != str(user_id):
+            return None
+        if state.timeout is not None:
+            IOLoop.current().remove_timeout(state.timeout)
+            state.timeout = None
+        previous_node, state.node = state.node, node
+        return state.session_id, state.acked_seq, previous_node
+
+    async def _take_over(self, node: str, token: str) -> Optional[int]:
+        router = _router()
+        if not router.enabled or node == router.node:
+            return await self.take_over_local(token)
+        try:
+            return await router.internal_request(node, 'party_session_take_over', token=token)
+        except Exception:
+            logger.exception('Cannot take over party session connection from %s.', node)
+
+    async def take_over_local(self, token: str) -> Optional[int]:
+        """Close connection of this node attached to the session, return its acknowledged seq."""
+        handler = self.handlers.pop(token, None)
+        if handler is None:
+            return None
+        return await handler.detach('Session is resumed by another connection')
+
+    async def discard(self, party_id: int, session_id: Optional[int] = None) -> None:
+        """Forget the session, or all sessions of the party, so it can not be resumed."""
+        await _on_owner(party_id, 'party_session_discard', self.discard_local, session_id=session_id)
+
+    def discard_local(self, party_id: int, session_id: Optional[int] = None) -> None:
+        for token, state in list(self.states.items()):
+            if self.party_id(token) != party_id:
+                continue
+            if session_id is not None and state.session_id != session_id:
+                continue
+            del self.states[token]
+            if state.timeout is not None:
+                IOLoop.current().remove_timeout(state.timeout)
+
+
+party_events = PartyEvents()
+session_resumer = SessionResumer()
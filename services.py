@@ -1,17 +1,143 @@
 from anthill.platform.services import PlainService, MasterRole
-from anthill.framework.utils.asynchronous import as_future
+from anthill.framework.utils.asynchronous import as_future, thread_pool_exec as future_exec
 from anthill.framework.core.cache import caches
+from anthill.framework.conf import settings
+from game_master.importing import warm_up
+from game_master.cache import ControllersStorage
+from game_master.moderation import moderation_cache, SYNC_INTERVAL
+from game_master.forecasting import prewarmer, INTERVAL as PREWARM_INTERVAL
+from game_master.loadhistory import load_history
+from game_master.snapshots import snapshot_manager, SNAPSHOTS
+from game_master.failure_detector import failure_detector, TICK as FAILURE_DETECTOR_TICK
+from tornado.ioloop import IOLoop, PeriodicCallback
+import logging
+import time
+
+logger = logging.getLogger('anthill.application')
 
 
 class Service(MasterRole, PlainService):
     """Anthill default service."""
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.moderation_sync = PeriodicCallback(moderation_cache.sync, SYNC_INTERVAL * 1000)
+        self.prewarm = PeriodicCallback(self.prewarm_rooms, PREWARM_INTERVAL * 1000)
+        self.prewarm_refit_at = 0
+        self.snapshots = PeriodicCallback(self.save_snapshot, SNAPSHOTS.get('INTERVAL', 60) * 1000)
+        self.failure_detection = PeriodicCallback(failure_detector.tick, FAILURE_DETECTOR_TICK * 1000)
+        snapshot_manager.register('moderation', moderation_cache.dump, moderation_cache.restore)
+        snapshot_manager.register('load_history', load_history.dump, load_history.restore)
+        snapshot_manager.register('prewarm', prewarmer.dump, prewarmer.restore)
+
+    async def on_start(self) -> None:
+        if SNAPSHOTS.get('ENABLED', False):
+            await self.restore_snapshot()
+            self.snapshots.start()
+        await super().on_start()
+        io_loop = IOLoop.current()
+        failure_detector.on_suspect = lambda server_id: io_loop.add_callback(
+            self.on_server_suspected, server_id)
+        self.failure_detection.start()
+        self.moderation_sync.start()
+        if getattr(settings, 'PREWARM', {}).get('ENABLED', False):
+            self.prewarm.start()
+        io_loop.spawn_callback(self.warm_up)
+
+    async def warm_up(self) -> None:
+        """Load heavy modules and caches in background, after accepting traffic."""
+        from game_master.models import get_geoip
+        from game_master.api.v1.public import get_schema
+        await moderation_cache.sync()
+        try:
+            await self.load_server_regions()
+            await future_exec(warm_up, getattr(settings, 'WARM_UP_MODULES', ()))
+            await future_exec(get_geoip)
+            await future_exec(get_schema)
+        except Exception:
+            logger.exception('Warm up failed.')
+
+    # noinspection PyMethodMayBeStatic
+    async def load_server_regions(self) -> None:
+        """Load regions of servers used by admission control."""
+        from game_master.models import Server
+        await future_exec(Server.load_regions)
+
+    # noinspection PyMethodMayBeStatic
+    async def on_server_suspected(self, server_id: int) -> None:
+        from game_master.models import Server
+        phi = failure_detector.phi(server_id)
+        logger.warning('Server %s is suspected to be failed (phi=%.1f).', server_id, phi)
+        try:
+            server = await future_exec(Server.query.get, server_id)
+            if server is not None and server.status != 'failed':
+                await server.mark_failed('Heartbeat timeout (phi=%.1f)' % phi)
+        except Exception:
+            logger.exception('Cannot mark server %s as failed.', server_id)
+
+    async def prewarm_rooms(self) -> None:
+        """Spawn rooms ahead of predicted demand, refitting forecasts hourly."""
+        now = time.time()
+        try:
+            if now - self.prewarm_refit_at > 3600:
+                await prewarmer.refit(now)
+                self.prewarm_refit_at = now
+            await prewarmer.run(now)
+        except Exception:
+            logger.exception('Rooms pre-warming failed.')
+
+    async def restore_snapshot(self) -> None:
+        from game_master.models import Server
+        try:
+            created_at = await future_exec(snapshot_manager.restore)
+        except Exception:
+            logger.exception('Cannot restore state from snapshot.')
+            return
+        if created_at is None:
+            return
+        logger.info('State restored from snapshot taken %.1f seconds ago.', time.time() - created_at)
+
+        async def catch_up():
+            try:
+                await future_exec(Server.catch_up_load_history, created_at)
+                await prewarmer.prune()
+            except Exception:
+                logger.exception('Catch up after snapshot restore failed.')
+
+        IOLoop.current().spawn_callback(catch_up)
+
+    async def save_snapshot(self) -> None:
+        try:
+            created_at, payloads = snapshot_manager.dump()
+            await future_exec(snapshot_manager.save, created_at, payloads)
+        except Exception:
+            logger.exception('Cannot save snapshot.')
+
+    async def on_stop(self) -> None:
+        self.failure_detection.stop()
+        self.moderation_sync.stop()
+        self.prewarm.stop()
+        if SNAPSHOTS.get('ENABLED', False):
+            self.snapshots.stop()
+            await self.save_snapshot()
+        await super().on_stop()
+
     @as_future
-    def storage(self):
-        return caches['controllers']
+    def storage(self) -> ControllersStorage:
+        return ControllersStorage(caches['controllers'])
 
     async def heartbeat_callback(self, controller, report):
-        pass
+        """
+        Record controller heartbeat. Failure detector starts tracking
+        a server only after its first heartbeat received by this process.
+        """
+        from game_master.models import Server
+        name = getattr(controller, 'name', controller)
+        server = await future_exec(Server.query.filter_by(name=name).first)
+        if server is None:
+            logger.warning('Heartbeat from unknown controller: %s.', name)
+            return
+        await server.heartbeat(report)
 
     async def controllers_registry(self):
         # TODO: get all controllers from database
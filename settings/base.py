@@ -64,6 +64,12 @@ LOGGING = {
         'require_debug_true': {
             '()': 'anthill.framework.utils.log.RequireDebugTrue',
         },
+        'sample_access': {
+            # Only 10% of successful requests are logged, warnings and errors always are.
+            '()': 'game_master.log.SamplingFilter',
+            'rate': 0.1,
+            'min_level': 'WARNING',
+        },
     },
     'formatters': {
         'anthill.server': {
@@ -82,11 +88,17 @@ LOGGING = {
         },
         'anthill.server': {
             'level': 'DEBUG',
-            'class': 'logging.handlers.RotatingFileHandler',
+            # Records are written and rotated by a background thread,
+            # use `logging.handlers.RotatingFileHandler` class for synchronous writes.
+            '()': 'game_master.log.QueueRotatingFileHandler',
             'filename': os.path.join(LOGGING_ROOT_DIR, 'game_master.log'),
             'formatter': 'anthill.server',
             'maxBytes': 100 * 1024 * 1024,  # 100 MiB
-            'backupCount': 10
+            'backupCount': 10,
+            'capacity': 10000,  # records
+            'policy': 'drop_old',
+            'batch_size': 256,
+            'never_drop_level': 'ERROR',
         },
         'mail_admins': {
             'level': 'ERROR',
@@ -106,6 +118,7 @@ LOGGING = {
         },
         'tornado.access': {
             'handlers': ['anthill.server'],
+            'filters': ['sample_access'],
             'level': 'INFO',
             'propagate': False
         },
@@ -153,6 +166,166 @@ LOGGING = {
 
 GEOIP_PATH = os.path.join(BASE_DIR, '../')
 
+###########
+# STARTUP #
+###########
+
+# Modules imported in background once the service is accepting traffic.
+# Set GAME_MASTER_LAZY_IMPORTS=1 to defer heavy dependencies until first use,
+# see `python manage.py import_profile` for import times.
+WARM_UP_MODULES = (
+    'game_master.api.v1.public',
+)
+
+##############
+# MODERATION #
+##############
+
+MODERATION_CACHE = {
+    'SYNC_INTERVAL': 60,  # seconds
+    'MAX_STALENESS': 300,  # seconds, remote lookups are used beyond that
+    'NEGATIVE_TTL': 30,  # seconds
+    'NEGATIVE_MAX_SIZE': 100000,
+    'RETRY_DELAY': 5,  # seconds, remote lookups are paused after a failure
+    'FAIL_OPEN': True,  # answer from the stale copy if moderation service is down
+}
+
+############
+# SHARDING #
+############
+
+# Parties and rooms are owned by service processes by consistent hashing.
+# NODES are internal API service names of all processes, NODE is the name
+# of the current one (can be set by GAME_MASTER_NODE environment variable).
+# Every node is a separately deployed service instance, the service does
+# not start extra processes itself.
+SHARDING = {
+    'NODES': (),
+    'NODE': None,
+    'REPLICAS': 128,
+}
+
+#####################
+# ADMISSION CONTROL #
+#####################
+
+# RATE and BURST configure token buckets kept per region and per application
+# version. Requests over MAX_CONCURRENCY wait in a queue of MAX_QUEUE size
+# for QUEUE_TIMEOUT seconds at most. Rejected requests raise
+# `game_master.admission.AdmissionRejected` with `retry_after` hint.
+ADMISSION_CONTROL = {
+    'room.join': {
+        'RATE': 200,  # per second
+        'BURST': 400,
+        'MAX_CONCURRENCY': 64,
+        'MAX_QUEUE': 256,
+        'QUEUE_TIMEOUT': 2,  # seconds
+    },
+    'room.spawn': {
+        'RATE': 20,
+        'BURST': 40,
+        'MAX_CONCURRENCY': 16,
+        'MAX_QUEUE': 64,
+        'QUEUE_TIMEOUT': 5,
+    },
+    'party.start': {
+        'RATE': 50,
+        'BURST': 100,
+        'MAX_CONCURRENCY': 32,
+        'MAX_QUEUE': 128,
+        'QUEUE_TIMEOUT': 5,
+    },
+}
+
+################
+# LOAD HISTORY #
+################
+
+# Heartbeat metrics of every server are kept in memory: last RAW_SIZE samples
+# and downsampled ROLLUPS as (bucket width in seconds, number of buckets).
+LOAD_HISTORY = {
+    'RAW_SIZE': 256,
+    'ROLLUPS': ((60, 240), (900, 192)),
+    'EWMA_HALF_LIFE': 60,  # seconds
+    'TREND_WINDOW': 300,  # seconds
+    'PREDICTION_HORIZON': 60,  # seconds
+}
+
+###########
+# PREWARM #
+###########
+
+# Rooms are spawned ahead of demand predicted from weekly room creation
+# history per region and application version.
+# Use `python manage.py prewarm_replay` to evaluate on recorded traces.
+PREWARM = {
+    'ENABLED': False,
+    'SLOT': 15 * 60,  # seconds
+    'SMOOTHING': 0.3,  # weight of the most recent week
+    'HISTORY_WEEKS': 4,
+    'LEAD_TIME': 60,  # seconds, expected room startup time
+    'INTERVAL': 60,  # seconds
+    'SAFETY_FACTOR': 1.2,
+    'MAX_WARM_ROOMS': 20,  # per region and application version
+    'MAX_PLAYERS_COUNT': 10,
+}
+
+####################
+# FAILURE DETECTOR #
+####################
+
+# Servers are suspected when phi (suspicion level based on heartbeat
+# inter-arrival times) reaches THRESHOLD, and are excluded from placement
+# until the next heartbeat.
+FAILURE_DETECTOR = {
+    'TICK': 0.1,  # seconds, timer wheel resolution
+    'THRESHOLD': 8.0,
+    'WINDOW': 100,  # number of inter-arrival times kept
+    'MIN_STD': 0.5,  # seconds
+    'ACCEPTABLE_PAUSE': 0.0,  # seconds
+    'FIRST_HEARTBEAT_ESTIMATE': 10.0,  # seconds
+}
+
+##################
+# PARTY SESSIONS #
+##################
+
+# Party sessions of disconnected clients are kept for RESUME_GRACE seconds.
+# Reconnecting with the resume token replays missed events from the last
+# EVENT_BUFFER_SIZE events of the party. Events and resume state are kept
+# by the node owning the party (see SHARDING).
+PARTY_SESSIONS = {
+    'RESUME_GRACE': 30,  # seconds
+    'EVENT_BUFFER_SIZE': 256,
+    'MAX_BUFFERS': 10000,
+}
+
+##############
+# JSON PATCH #
+##############
+
+# Patches of the same document coming within COALESCE_DELAY are written together.
+JSON_PATCH = {
+    'COALESCE_DELAY': 0.05,  # seconds
+}
+
+#############
+# SNAPSHOTS #
+#############
+
+# In-process state (moderation cache, servers load history, pre-warmed rooms)
+# is saved periodically and restored on startup.
+# STORAGE is either `file` (PATH) or `cache` (CACHE alias and KEY).
+# With sharding, the node name is added to PATH and KEY of each process.
+SNAPSHOTS = {
+    'ENABLED': True,
+    'INTERVAL': 60,  # seconds
+    'STORAGE': 'file',
+    'PATH': os.path.join(BASE_DIR, 'snapshots', 'game_master.snapshot'),
+    'CACHE': 'default',
+    'KEY': 'snapshot',
+}
+
 #########
 # HTTPS #
 #########
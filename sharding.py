@@ -0,0 +1,102 @@
+# Consistent-hash ownership of parties and rooms across service processes.
+from anthill.framework.conf import settings
+from anthill.platform.api.internal import InternalAPIMixin
+from typing import Iterable, Optional, Set
+import bisect
+import hashlib
+import os
+
+SHARDING = getattr(settings, 'SHARDING', {})
+
+NODES = tuple(SHARDING.get('NODES', ()))
+NODE = os.environ.get('GAME_MASTER_NODE') or SHARDING.get('NODE')
+REPLICAS = SHARDING.get('REPLICAS', 128)
+
+
+class EntityNotFound(Exception):
+    def __init__(self, kind: str, entity_id):
+        super().__init__('%s %s not found' % (kind.capitalize(), entity_id))
+        self.kind = kind
+        self.entity_id = entity_id
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Consistent hash ring with virtual nodes."""
+
+    def __init__(self, nodes: Iterable[str] = (), replicas: int = REPLICAS):
+        self.replicas = replicas
+        self._hashes = []
+        self._nodes = []
+        for node in nodes:
+            self.add(node)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    @property
+    def nodes(self) -> Set[str]:
+        return set(self._nodes)
+
+    def add(self, node: str) -> None:
+        for i in range(self.replicas):
+            h = _hash('%s#%d' % (node, i))
+            index = bisect.bisect(self._hashes, h)
+            self._hashes.insert(index, h)
+            self._nodes.insert(index, node)
+
+    def remove(self, node: str) -> None:
+        for index in reversed(range(len(self._nodes))):
+            if self._nodes[index] == node:
+                del self._hashes[index]
+                del self._nodes[index]
+
+    def get(self, key: str) -> Optional[str]:
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._nodes[index]
+
+
+class ShardRouter(InternalAPIMixin):
+    """
+    Decides which service process owns a party or a room.
+
+    Each process is identified by `SHARDING['NODE']` (or `GAME_MASTER_NODE`
+    environment variable), an internal API service name listed in
+    `SHARDING['NODES']`. Operations on entities owned by other nodes are
+    forwarded to them over the internal API. Without configured nodes
+    every entity is owned locally.
+
+    Scope: the service does not start extra processes itself, every node
+    is a separately deployed service instance registered under its own
+    name. Only room join, room spawn and party start are routed, so that
+    bursts on one entity are handled by one process. Entity state is not
+    kept in memory, it is always read from the database, so operations
+    that are not routed stay consistent when run on any node.
+    """
+
+    def __init__(self, node: Optional[str] = NODE, nodes: Iterable[str] = NODES):
+        self.node = node
+        self.ring = HashRing(nodes)
+
+    @property
+    def enabled(self) -> bool:
+        return self.node is not None and len(self.ring) > 1
+
+    def owner(self, kind: str, entity_id) -> Optional[str]:
+        return self.ring.get('%s:%s' % (kind, entity_id))
+
+    def is_local(self, kind: str, entity_id) -> bool:
+        if not self.enabled or entity_id is None:
+            return True
+        return self.owner(kind, entity_id) == self.node
+
+    async def forward(self, kind: str, entity_id, method: str, **kwargs):
+        return await self.internal_request(self.owner(kind, entity_id), method, **kwargs)
+
+
+router = ShardRouter()
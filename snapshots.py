@@ -0,0 +1,224 @@
+# Snapshots of in-process state, used for warm restarts.
+from anthill.framework.conf import settings
+from anthill.framework.core.cache import caches
+from array import array
+from typing import Callable, Dict, List, Optional, Tuple
+import logging
+import math
+import os
+import struct
+import sys
+import tempfile
+import time
+import zlib
+
+logger = logging.getLogger('anthill.application')
+
+SNAPSHOTS = getattr(settings, 'SNAPSHOTS', {})
+
+MAGIC = b'GMSN'
+VERSION = 1
+HEADER = struct.Struct('>4sHdH')  # magic, version, created at, sections count
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class Writer:
+    """Appends primitive values to a binary buffer in network byte order."""
+
+    def __init__(self):
+        self.chunks: List[bytes] = []
+
+    def write_int(self, value: int) -> None:
+        self.chunks.append(struct.pack('>q', value))
+
+    def write_optional_int(self, value: Optional[int]) -> None:
+        self.write_int(-1 if value is None else value)
+
+    def write_float(self, value: Optional[float]) -> None:
+        self.chunks.append(struct.pack('>d', math.nan if value is None else value))
+
+    def write_bytes(self, value: bytes) -> None:
+        self.chunks.append(struct.pack('>I', len(value)))
+        self.chunks.append(value)
+
+    def write_str(self, value: str) -> None:
+        self.write_bytes(value.encode())
+
+    def write_array(self, value: array) -> None:
+        if sys.byteorder == 'little':  # arrays are always stored big-endian
+            value = array(value.typecode, value)
+            value.byteswap()
+        self.write_str(value.typecode)
+        self.write_bytes(value.tobytes())
+
+    def getvalue(self) -> bytes:
+        return b''.join(self.chunks)
+
+
+class Reader:
+    def __init__(self, data: bytes):
+        self.data = memoryview(data)
+        self.offset = 0
+
+    def _unpack(self, fmt: str):
+        value, = struct.unpack_from(fmt, self.data, self.offset)
+        self.offset += struct.calcsize(fmt)
+        return value
+
+    def read_int(self) -> int:
+        return self._unpack('>q')
+
+    def read_optional_int(self) -> Optional[int]:
+        value = self.read_int()
+        return None if value == -1 else value
+
+    def read_float(self) -> Optional[float]:
+        value = self._unpack('>d')
+        return None if math.isnan(value) else value
+
+    def read_bytes(self) -> bytes:
+        size = self._unpack('>I')
+        value = bytes(self.data[self.offset:self.offset + size])
+        self.offset += size
+        return value
+
+    def read_str(self) -> str:
+        return self.read_bytes().decode()
+
+    def read_array(self) -> array:
+        value = array(self.read_str())
+        value.frombytes(self.read_bytes())
+        if sys.byteorder == 'little':
+            value.byteswap()
+        return value
+
+
+class FileStorage:
+    def __init__(self, path: str):
+        self.path = path
+
+    def save(self, data: bytes) -> None:
+        directory = os.path.dirname(self.path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.snapshot-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def load(self) -> Optional[bytes]:
+        try:
+            with open(self.path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+
+class CacheStorage:
+    def __init__(self, alias: str, key: str):
+        self.alias = alias
+        self.key = key
+
+    def save(self, data: bytes) -> None:
+        caches[self.alias].set(self.key, data, timeout=None)
+
+    def load(self) -> Optional[bytes]:
+        return caches[self.alias].get(self.key)
+
+
+Dump = Callable[[Writer], None]
+Restore = Callable[[Reader, float], None]
+
+
+class SnapshotManager:
+    """
+    Collects state from registered sections into a compressed binary snapshot
+    and restores it back. Each section is written and read independently,
+    a section that fails to restore is skipped.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.sections: Dict[str, Tuple[Dump, Restore]] = {}
+
+    def register(self, name: str, dump: Dump, restore: Restore) -> None:
+        self.sections[name] = (dump, restore)
+
+    def dump(self) -> Tuple[float, Dict[str, bytes]]:
+        """Serialize all sections. Cheap enough to run on IOLoop thread."""
+        payloads = {}
+        for name, (dump, _) in self.sections.items():
+            writer = Writer()
+            dump(writer)
+            payloads[name] = writer.getvalue()
+        return time.time(), payloads
+
+    @staticmethod
+    def encode(created_at: float, payloads: Dict[str, bytes]) -> bytes:
+        writer = Writer()
+        for name, payload in payloads.items():
+            writer.write_str(name)
+            writer.write_bytes(payload)
+        body = zlib.compress(writer.getvalue())
+        return HEADER.pack(MAGIC, VERSION, created_at, len(payloads)) + body
+
+    @staticmethod
+    def decode(data: bytes) -> Tuple[float, Dict[str, bytes]]:
+        try:
+            magic, version, created_at, count = HEADER.unpack_from(data)
+        except struct.error:
+            raise SnapshotError('Snapshot is truncated')
+        if magic != MAGIC or version != VERSION:
+            raise SnapshotError('Unknown snapshot format')
+        reader = Reader(zlib.decompress(data[HEADER.size:]))
+        payloads = {}
+        for _ in range(count):
+            name = reader.read_str()
+            payloads[name] = reader.read_bytes()
+        return created_at, payloads
+
+    def save(self, created_at: float, payloads: Dict[str, bytes]) -> None:
+        self.storage.save(self.encode(created_at, payloads))
+
+    def restore(self) -> Optional[float]:
+        """Restore state from the latest snapshot. Return its creation time."""
+        data = self.storage.load()
+        if not data:
+            return None
+        created_at, payloads = self.decode(data)
+        for name, (_, restore) in self.sections.items():
+            if name not in payloads:
+                continue
+            try:
+                restore(Reader(payloads[name]), created_at)
+            except Exception:
+                logger.exception('Cannot restore `%s` from snapshot.', name)
+        return created_at
+
+
+def get_storage(node: Optional[str] = None):
+    """
+    Storage of the snapshot of the `node` process (`sharding.NODE` by default).
+    Every sharded process has its own snapshot, since their states differ.
+    """
+    if node is None:
+        from game_master.sharding import NODE as node
+    if SNAPSHOTS.get('STORAGE', 'file') == 'cache':
+        key = SNAPSHOTS.get('KEY', 'snapshot')
+        if node:
+            key = '%s:%s' % (key, node)
+        return CacheStorage(SNAPSHOTS.get('CACHE', 'default'), key)
+    path = SNAPSHOTS.get('PATH', 'snapshot.bin')
+    if node:
+        root, ext = os.path.splitext(path)
+        path = '%s.%s%s' % (root, node, ext)
+    return FileStorage(path)
+
+
+snapshot_manager = SnapshotManager(get_storage())